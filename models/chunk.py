@@ -18,6 +18,7 @@ class Chunk:
     start_char: Optional[int] = None
     end_char: Optional[int] = None
     embedding: Optional[np.ndarray] = None
+    corpus_index: Optional[int] = None # Row of this chunk in the consolidated chunk embedding matrix
 
     # New fields for knowledge topology analysis
     semantic_neighbors: List[str] = dataclasses.field(default_factory=list)
@@ -1,29 +1,127 @@
+import os
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.decomposition import PCA
 from umap import UMAP
 from typing import Tuple, List, Optional, Dict, Any, Set
 import networkx as nx # Import networkx
 # networkx.community will be accessed directly via nx.community
 import matplotlib.colors as mcolors
 import matplotlib.cm as cm
+from services.knn_kernel import centroid_argmax, pair_cosine, query_cosine
+
+try:
+    from threadpoolctl import threadpool_limits # Ships with scikit-learn
+except ImportError:
+    threadpool_limits = None
+
+try:
+    from scipy.linalg.blas import ssyrk # Symmetric rank-k update: computes one triangle of A @ A.T
+except ImportError:
+    ssyrk = None
+
+try:
+    import scipy.sparse as sp # CSR product for embedding matrices that are mostly zeros
+except ImportError:
+    sp = None
+
+try:
+    import faiss # Persistent inner-product index for repeated KNN queries over one corpus
+except ImportError:
+    faiss = None
+
+try:
+    import torch # Installed alongside sentence-transformers; used for GPU similarity when a device exists
+except ImportError:
+    torch = None
+
+try:
+    import igraph # C implementations of betweenness and Louvain; NetworkX is the fallback
+except ImportError:
+    igraph = None
+
+try:
+    # RAPIDS GPU UMAP (conda/NVIDIA index install, so not in requirements.txt); umap-learn is the CPU path
+    from cuml.manifold import UMAP as cuUMAP
+    import cupy
+except ImportError:
+    cuUMAP = None
+    cupy = None
+
+try:
+    import simsimd # SIMD (AVX2/AVX-512/NEON) cosine kernels for the KNN scan
+except ImportError:
+    simsimd = None
+
+def _as_gemm_ready(matrix: np.ndarray) -> np.ndarray:
+    """Returns the matrix as C-contiguous float32 (no copy if it already is) so BLAS takes the SGEMM fast path."""
+    if matrix.dtype == np.float32 and matrix.flags['C_CONTIGUOUS']:
+        return matrix
+    return np.ascontiguousarray(matrix, dtype=np.float32)
 
 class AnalysisService:
     """Provides methods for embedding analysis, including similarity calculation, dimensionality reduction, and nearest neighbor search."""
     MIN_N_NEIGHBORS_FOR_UMAP = 2 # UMAP requirement
+    MAX_DIM_FOR_PCA = 32 # Below this, a closed-form PCA is used instead of fitting UMAP
+    SELF_MATCH_ATOL = 1e-5 # Similarity this close to 1.0 is treated as the query itself (float32 rounding)
+    INT8_OVERSAMPLE = 4 # Candidates kept from the int8 scan per requested neighbour, re-scored in float32
+    HNSW_MIN_ROWS = 20000 # From this corpus size an HNSW graph replaces the exact flat scan (recall@1 ~0.99)
+    HNSW_M = 32 # Graph neighbours per node
+    HNSW_EF_CONSTRUCTION = 200
+    HNSW_EF_SEARCH = 64
+
+    def __init__(self):
+        # Make sure OpenBLAS/MKL is allowed to use every core for the similarity GEMMs
+        if threadpool_limits is not None:
+            try:
+                threadpool_limits(limits=os.cpu_count(), user_api='blas')
+            except Exception as e:
+                print(f"Warning [AnalysisService]: Could not configure BLAS threads: {e}")
+        # Detected once; the service itself is held by st.cache_resource
+        self.torch_device = self._detect_gpu()
+
+    @staticmethod
+    def _detect_gpu() -> Optional[str]:
+        """Returns 'cuda' or 'mps' when PyTorch can reach a GPU, otherwise None (the CPU path stays NumPy/BLAS)."""
+        if torch is None:
+            return None
+        try:
+            if torch.cuda.is_available():
+                return 'cuda'
+            if torch.backends.mps.is_available():
+                return 'mps'
+        except Exception as e:
+            print(f"Warning [AnalysisService]: Could not query PyTorch devices: {e}")
+        return None
+
+    @staticmethod
+    def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+        """L2-normalises each row into a C-contiguous float32 array; zero rows stay zero (as in sklearn)."""
+        matrix = _as_gemm_ready(matrix)
+        # Squared row norms via einsum: one fused multiply-add pass, no abs/power temporaries as in np.linalg.norm
+        norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))[:, None]
+        norms[norms == 0.0] = 1.0
+        return matrix / norms
+
+    @staticmethod
+    def quantize_rows_int8(matrix: np.ndarray) -> np.ndarray:
+        """Quantises each row to int8 with its own max-abs scale; cosine is scale-invariant, so no scales are kept."""
+        matrix = _as_gemm_ready(matrix)
+        scales = np.abs(matrix).max(axis=1, keepdims=True)
+        scales[scales == 0.0] = 1.0
+        return np.clip(np.rint(matrix * (127.0 / scales)), -127, 127).astype(np.int8)
 
     def calculate_similarity(self, emb1: np.ndarray, emb2: np.ndarray) -> float:
         """Calculates the cosine similarity between two embedding vectors."""
-        if emb1.ndim == 1:
-            emb1 = emb1.reshape(1, -1)
-        if emb2.ndim == 1:
-            emb2 = emb2.reshape(1, -1)
-        
-        if emb1.shape[1] != emb2.shape[1]:
-            raise ValueError(f"Embedding dimensions do not match: {emb1.shape[1]} vs {emb2.shape[1]}")
+        if emb1.ndim == 2:
+            emb1 = emb1[0]
+        if emb2.ndim == 2:
+            emb2 = emb2[0]
+
+        if emb1.shape[0] != emb2.shape[0]:
+            raise ValueError(f"Embedding dimensions do not match: {emb1.shape[0]} vs {emb2.shape[0]}")
 
-        similarity = cosine_similarity(emb1, emb2)
-        # Return the single similarity score (cosine_similarity returns a 2D array)
-        return float(similarity[0, 0])
+        # Called per adjacent sentence pair by the semantic chunker, so use the fused kernel
+        return pair_cosine(emb1, emb2)
 
     def reduce_dimensions(self, embeddings: np.ndarray, n_components: int = 2) -> Optional[np.ndarray]:
         """Reduces the dimensionality of embeddings using UMAP."""
@@ -43,6 +141,20 @@ class AnalysisService:
              print(f"Warning [AnalysisService]: UMAP requires at least {min_samples_needed} samples (found {n_samples}). Cannot reduce dimensions.")
              return None # Return None to indicate failure
 
+        # --- Low-dimensional input: no manifold to learn, skip UMAP ---
+        n_features = embeddings.shape[1]
+        if n_features <= n_components:
+            reduced_embeddings = embeddings.astype(np.float32, copy=False)
+            if n_features < n_components: # Pad so callers always get n_components columns
+                padding = np.zeros((n_samples, n_components - n_features), dtype=np.float32)
+                reduced_embeddings = np.hstack([reduced_embeddings, padding])
+            return reduced_embeddings
+        if n_features < self.MAX_DIM_FOR_PCA and n_components <= n_samples:
+            try:
+                return PCA(n_components=n_components).fit_transform(embeddings).astype(np.float32, copy=False)
+            except Exception as e:
+                print(f"Warning [AnalysisService]: PCA reduction failed, falling back to UMAP: {e}")
+
         # Adjust n_neighbors based on samples, ensuring it's >= MIN_N_NEIGHBORS_FOR_UMAP
         # A common default for UMAP is 15
         n_neighbors = min(15, n_samples - 1) # Max n_neighbors is n_samples - 1
@@ -58,6 +170,14 @@ class AnalysisService:
             umap_init_method = 'random' if n_samples < 5 else 'spectral'
             print(f"DEBUG [AnalysisService]: Using UMAP init method: {umap_init_method}")
 
+            if cuUMAP is not None and self.torch_device == 'cuda':
+                try:
+                    gpu_reducer = cuUMAP(n_components=n_components, n_neighbors=n_neighbors, min_dist=0.1, random_state=42, init=umap_init_method)
+                    gpu_coords = gpu_reducer.fit_transform(cupy.asarray(embeddings, dtype=cupy.float32))
+                    return cupy.asnumpy(gpu_coords).astype(np.float32, copy=False)
+                except Exception as gpu_e:
+                    print(f"Warning [AnalysisService]: cuML UMAP failed, falling back to CPU UMAP: {gpu_e}")
+
             reducer = UMAP(
                 n_components=n_components,
                 n_neighbors=n_neighbors,
@@ -74,13 +194,48 @@ class AnalysisService:
             # raise e 
             return None # Return None on error
 
+    def build_knn_index(self, corpus_norm: np.ndarray) -> Optional[Any]:
+        """Builds a FAISS inner-product index over L2-normalised rows (inner product = cosine); None if FAISS is unavailable.
+
+        Corpora of HNSW_MIN_ROWS rows or more get an approximate HNSW graph (logarithmic query cost), smaller ones an exact flat index.
+        """
+        if faiss is None or not isinstance(corpus_norm, np.ndarray) or corpus_norm.ndim != 2 or corpus_norm.shape[0] < 1:
+            return None
+        try:
+            n, dim = corpus_norm.shape
+            if n >= self.HNSW_MIN_ROWS:
+                index = faiss.IndexHNSWFlat(dim, self.HNSW_M, faiss.METRIC_INNER_PRODUCT) # Scores stay cosines, as with IndexFlatIP
+                index.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+                index.add(_as_gemm_ready(corpus_norm))
+                index.hnsw.efSearch = self.HNSW_EF_SEARCH
+                return index
+            index = faiss.IndexFlatIP(dim)
+            index.add(_as_gemm_ready(corpus_norm))
+            return index
+        except Exception as e:
+            print(f"Warning [AnalysisService]: Could not build FAISS index: {e}")
+            return None
+
     def find_k_nearest(
         self, 
         query_emb: np.ndarray, 
         corpus_embeddings: np.ndarray, 
-        k: int
+        k: int,
+        pre_normalized: bool = False,
+        corpus_i8: Optional[np.ndarray] = None,
+        index: Optional[Any] = None,
+        exclude_index: Optional[int] = None
     ) -> Tuple[List[int], List[float]]:
-        """Finds the k nearest embeddings in the corpus to the query embedding."""
+        """Finds the k nearest embeddings in the corpus to the query embedding.
+
+        Pass pre_normalized=True when the corpus rows are already L2-normalised (see normalize_rows);
+        only the query is then normalised and cosine reduces to a single GEMV.
+        With corpus_i8 (quantize_rows_int8 of the same corpus) and SimSIMD available, the full scan runs
+        on int8 and only the best candidates are re-scored in float32, so returned scores stay exact.
+        With index (build_knn_index of the same normalised corpus), the search is delegated to FAISS.
+        With exclude_index (the query's own corpus row), that row is masked out instead of filtering
+        candidates by similarity ~1.0, so exactly min(k, n-1) neighbours come back.
+        """
         if query_emb.ndim == 1:
             query_emb = query_emb.reshape(1, -1)
         
@@ -90,30 +245,115 @@ class AnalysisService:
         if query_emb.shape[1] != corpus_embeddings.shape[1]:
             raise ValueError(f"Query and corpus embedding dimensions do not match: {query_emb.shape[1]} vs {corpus_embeddings.shape[1]}")
 
-        # Calculate cosine similarities
-        similarities = cosine_similarity(query_emb, corpus_embeddings)[0] # Get the similarity scores for the single query
+        query_emb = _as_gemm_ready(query_emb)
+        corpus_embeddings = _as_gemm_ready(corpus_embeddings)
+
+        k_adjusted = min(k + 1, corpus_embeddings.shape[0]) # k+1 in case the query is in the corpus
+        if index is not None and index.ntotal == corpus_embeddings.shape[0]:
+            scores, ids = index.search(self.normalize_rows(query_emb), k_adjusted)
+            found = ids[0] >= 0 # FAISS pads with -1 when fewer results exist
+            if exclude_index is not None:
+                found &= ids[0] != exclude_index
+                return ids[0][found][:k].tolist(), scores[0][found][:k].tolist()
+            return self._exclude_self(ids[0][found], scores[0][found], k)
+
+        # Calculate cosine similarities (SimSIMD kernel when available; it returns distances)
+        n_candidates = min(self.INT8_OVERSAMPLE * (k + 1), corpus_embeddings.shape[0])
+        if pre_normalized and corpus_i8 is not None and simsimd is not None and n_candidates < corpus_embeddings.shape[0]:
+            # Quarter of the memory traffic for the scan; shortlist then re-scored exactly
+            approx = 1.0 - np.asarray(simsimd.cdist(self.quantize_rows_int8(query_emb), corpus_i8, metric='cosine'))[0]
+            shortlist = np.argpartition(-approx, n_candidates - 1)[:n_candidates]
+            similarities = np.full(corpus_embeddings.shape[0], -np.inf, dtype=np.float32)
+            similarities[shortlist] = corpus_embeddings[shortlist] @ self.normalize_rows(query_emb)[0]
+        elif pre_normalized:
+            similarities = corpus_embeddings @ self.normalize_rows(query_emb)[0]
+        elif simsimd is not None:
+            similarities = 1.0 - np.asarray(simsimd.cdist(query_emb, corpus_embeddings, metric='cosine'))[0]
+        else:
+            similarities = query_cosine(query_emb[0], corpus_embeddings) # Fused norm + dot scan (Numba when available)
+
+        if exclude_index is not None:
+            similarities[exclude_index] = -np.inf # One write instead of a post-filter; similarities is a fresh array
+            k_adjusted = min(k, len(similarities) - 1)
+            if k_adjusted < 1:
+                return [], []
 
         # Get the indices of the top k+1 similarities (in case query is in corpus)
-        # Argsort sorts in ascending order, so we take the end of the sorted list
-        k_adjusted = min(k + 1, len(similarities)) # Adjust k if corpus is smaller than k
-        nearest_indices_sorted = np.argsort(similarities)[-k_adjusted:]
-
-        # Exclude the query itself if it's identical (similarity ~1.0)
-        # We iterate from most similar (end of list) backwards
+        # argpartition selects them in O(N); only those k+1 are then sorted (descending)
+        if k_adjusted < len(similarities):
+            candidate_indices = np.argpartition(-similarities, k_adjusted - 1)[:k_adjusted]
+        else:
+            candidate_indices = np.arange(len(similarities))
+        nearest_indices_sorted = candidate_indices[np.argsort(similarities[candidate_indices])[::-1]]
+        if exclude_index is not None:
+            nearest_indices_sorted = nearest_indices_sorted[nearest_indices_sorted != exclude_index] # Only if k covered n
+            return nearest_indices_sorted.tolist(), similarities[nearest_indices_sorted].tolist()
+        return self._exclude_self(nearest_indices_sorted, similarities[nearest_indices_sorted], k)
+
+    def _exclude_self(self, indices: np.ndarray, scores: np.ndarray, k: int) -> Tuple[List[int], List[float]]:
+        """Takes up to k of the (descending) candidates, skipping the query itself (similarity ~1.0)."""
         top_k_indices = []
         top_k_scores = []
-        for idx in reversed(nearest_indices_sorted):
+        for idx, score in zip(indices, scores):
             # Use a tolerance for floating point comparison
-            if not np.isclose(similarities[idx], 1.0, atol=1e-8):
+            if not np.isclose(score, 1.0, atol=self.SELF_MATCH_ATOL):
                 top_k_indices.append(int(idx))
-                top_k_scores.append(float(similarities[idx]))
+                top_k_scores.append(float(score))
                 if len(top_k_indices) == k:
                     break
             # If the most similar *is* the query (or identical), check the next one
 
         # If after excluding self, we have fewer than k, take the available ones.
-        
-        return top_k_indices, top_k_scores 
+        return top_k_indices, top_k_scores
+
+    def find_centroid_nearest(
+        self,
+        selected_embeddings: np.ndarray,
+        corpus_norm: np.ndarray
+    ) -> Tuple[Optional[int], Optional[float]]:
+        """
+        Finds the item nearest to the centroid of the selected embeddings in a row-normalised corpus.
+        Centroid, normalisation and the 1-NN scan run as one compiled kernel (see services.knn_kernel).
+
+        Returns:
+            (index, similarity) of the nearest item, excluding items identical to the centroid, or (None, None).
+        """
+        if corpus_norm is None or len(selected_embeddings) == 0 or corpus_norm.shape[0] == 0:
+            return None, None
+        best_index, best_score = centroid_argmax(selected_embeddings, _as_gemm_ready(corpus_norm), self.SELF_MATCH_ATOL)
+        if best_index < 0:
+            return None, None
+        return best_index, best_score
+
+    def find_centroid_nearest_from_similarity(
+        self,
+        similarity_matrix: np.ndarray,
+        selected_indices: List[int],
+        selected_norms: Optional[np.ndarray] = None
+    ) -> Tuple[Optional[int], Optional[float]]:
+        """
+        Finds the item nearest to the centroid of the selected items using only a precomputed cosine similarity matrix.
+
+        Writing the selected raw vectors as x_i = n_i * u_i (u_i unit, n_i = |x_i|), cos(c, u_j) for the centroid
+        c = mean(x_i) equals sum_i(n_i S[i, j]) / sqrt(sum_ik(n_i n_k S[i, k])), so only the selected row norms are
+        needed at query time. This gives the same centroid as find_centroid_nearest; without selected_norms the
+        rows are weighted equally (centroid of the unit vectors).
+
+        Returns:
+            (index, similarity) of the nearest item, excluding items identical to the centroid, or (None, None).
+        """
+        weights = np.ones(len(selected_indices), dtype=np.float64) if selected_norms is None else np.asarray(selected_norms, dtype=np.float64)
+        rows = similarity_matrix[selected_indices]
+        centroid_sq_norm = float(weights @ rows[:, selected_indices] @ weights)
+        if centroid_sq_norm <= 0.0:
+            return None, None
+        scores = (weights @ rows / np.sqrt(centroid_sq_norm)).astype(np.float32)
+        # Exclude items identical to the centroid, mirroring find_k_nearest's self-match rule
+        scores[np.isclose(scores, 1.0, atol=self.SELF_MATCH_ATOL)] = -np.inf
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            return None, None
+        return best, float(scores[best])
 
     def calculate_centroid(self, points: np.ndarray) -> Optional[np.ndarray]:
         """Calculates the centroid (geometric center) of a set of points."""
@@ -142,8 +382,15 @@ class AnalysisService:
             print(f"Error calculating centroid: {e}")
             return None 
 
-    def calculate_similarity_matrix(self, embeddings_matrix: np.ndarray) -> Optional[np.ndarray]:
-        """Calculates the pairwise cosine similarity matrix for a matrix of embeddings."""
+    SIMILARITY_BLOCK_ROWS = 256 # Row tile for the similarity GEMM: 256*d*4 bytes stays in L2 for d≈768
+    SPARSE_DENSITY_MAX = 0.3 # Use the CSR product when fewer than this fraction of entries are nonzero
+    GPU_MIN_ROWS = 512 # Below this the host<->device copies cost more than the CPU SYRK
+
+    def calculate_similarity_matrix(self, embeddings_matrix: np.ndarray, pre_normalized: bool = False) -> Optional[np.ndarray]:
+        """Calculates the pairwise cosine similarity matrix for a matrix of embeddings.
+
+        Pass pre_normalized=True for rows already L2-normalised (see normalize_rows); the work is then only the SGEMM tiles.
+        """
         if not isinstance(embeddings_matrix, np.ndarray) or embeddings_matrix.ndim != 2 or embeddings_matrix.shape[0] < 1:
             print("Error: Input must be a valid 2D numpy array with at least one embedding.")
             return None
@@ -151,8 +398,43 @@ class AnalysisService:
         if embeddings_matrix.shape[0] == 1:
             return np.array([[1.0]])
         try:
-            # cosine_similarity calculates row-wise similarities
-            similarity_matrix = cosine_similarity(embeddings_matrix)
+            # L2-normalise rows once; zero vectors stay zero (same as sklearn's cosine_similarity)
+            corp_n = _as_gemm_ready(embeddings_matrix) if pre_normalized else self.normalize_rows(embeddings_matrix)
+
+            n = corp_n.shape[0]
+            block = self.SIMILARITY_BLOCK_ROWS
+            if sp is not None and np.count_nonzero(corp_n) < self.SPARSE_DENSITY_MAX * corp_n.size:
+                # Sparse rows (e.g. thresholded/PCA-truncated embeddings): the CSR product only touches
+                # pairs that share a nonzero coordinate. Exact, since no entries are dropped.
+                corp_csr = sp.csr_matrix(corp_n)
+                return (corp_csr @ corp_csr.T).toarray()
+            if self.torch_device is not None and n > self.GPU_MIN_ROWS:
+                try:
+                    with torch.inference_mode():
+                        # torch.from_numpy warns on read-only buffers (e.g. the shared memory map), so hand it a copy
+                        corp_t = torch.from_numpy(corp_n if corp_n.flags.writeable else corp_n.copy()).to(self.torch_device)
+                        return (corp_t @ corp_t.T).cpu().numpy()
+                except Exception as gpu_e: # e.g. out of device memory; fall through to the CPU path
+                    print(f"Warning: GPU similarity failed, using CPU: {gpu_e}")
+            if ssyrk is not None:
+                # One SYRK call computes only the upper triangle (half the FLOPs). Passing corp_n.T with trans=1
+                # avoids a Fortran-order copy; the transposed result is C-ordered with the lower triangle
+                # filled, which is mirrored block by block.
+                similarity_matrix = ssyrk(1.0, corp_n.T, trans=1).T
+                for i in range(0, n, block):
+                    end = min(i + block, n)
+                    diagonal_block = similarity_matrix[i:end, i:end]
+                    diagonal_block += np.tril(diagonal_block, -1).T
+                    similarity_matrix[i:end, end:] = similarity_matrix[end:, i:end].T
+                return similarity_matrix
+
+            # Tiled GEMM straight into a preallocated output. Only the upper block triangle is
+            # computed; each tile is mirrored into the lower triangle.
+            similarity_matrix = np.empty((n, n), dtype=np.float32)
+            for i in range(0, n, block):
+                end = min(i + block, n)
+                np.matmul(corp_n[i:end], corp_n[i:].T, out=similarity_matrix[i:end, i:])
+                similarity_matrix[end:, i:end] = similarity_matrix[i:end, end:].T
             # Ensure diagonal is exactly 1.0 (sometimes minor float errors, although often handled)
             # np.fill_diagonal(similarity_matrix, 1.0) # Optional: uncomment if needed
             return similarity_matrix
@@ -198,19 +480,86 @@ class AnalysisService:
             print("Error [create_semantic_graph]: Number of source documents must match embeddings.")
             return None, None, None # Modified return
 
-        # Compute similarity matrix if not provided
+        # Without a precomputed matrix, stream row blocks and keep only above-threshold pairs (O(B*N) memory, not O(N^2))
         if similarity_matrix is None:
-            print("Computing similarity matrix for graph...")
-            similarity_matrix = self.calculate_similarity_matrix(embeddings_matrix)
-            if similarity_matrix is None:
-                 print("Error [create_semantic_graph]: Failed to compute similarity matrix.")
-                 return None, None, None # Modified return
-            if similarity_matrix.shape != (num_items, num_items):
-                 print(f"Error [create_semantic_graph]: Sim matrix shape mismatch.")
+            print("Computing above-threshold similarity pairs for graph...")
+            try:
+                rows_idx, cols_idx, edge_scores = self.find_similar_pairs(embeddings_matrix, similarity_threshold)
+            except Exception as e:
+                 print(f"Error [create_semantic_graph]: Failed to compute similarities: {e}")
                  return None, None, None # Modified return
+            return self.build_graph_from_pairs(rows_idx, cols_idx, edge_scores, labels, source_documents, similarity_threshold)
+
+        return self.build_graph_from_sim(similarity_matrix, labels, source_documents, similarity_threshold)
+
+    def find_similar_pairs(self, embeddings_matrix: np.ndarray, similarity_threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds all pairs i < j with cosine similarity >= threshold using row-blocked GEMMs.
+        Each (B, N - i0) tile is thresholded and discarded, so the full N x N matrix is never materialised.
+
+        Returns:
+            (row indices, column indices, similarities) of the qualifying pairs.
+        """
+        corp_n = self.normalize_rows(embeddings_matrix)
+        n = corp_n.shape[0]
+        block = self.SIMILARITY_BLOCK_ROWS
+        tiles = ((i0, corp_n[i0:min(i0 + block, n)] @ corp_n[i0:].T) for i0 in range(0, n, block))
+        return self._upper_pairs_above(tiles, similarity_threshold)
+
+    @staticmethod
+    def _upper_pairs_above(tiles, similarity_threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Collects pairs i < j scoring >= threshold from (i0, tile) row blocks whose columns start at i0."""
+        rows_parts, cols_parts, score_parts = [], [], []
+        for i0, tile in tiles:
+            n_rows = tile.shape[0]
+            mask = tile >= similarity_threshold
+            mask[:, :n_rows] &= np.triu(np.ones((n_rows, n_rows), dtype=bool), k=1) # Within the diagonal block keep j > i
+            local_rows, local_cols = np.nonzero(mask)
+            rows_parts.append(local_rows + i0)
+            cols_parts.append(local_cols + i0)
+            score_parts.append(tile[local_rows, local_cols])
+        if not rows_parts:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        return np.concatenate(rows_parts), np.concatenate(cols_parts), np.concatenate(score_parts)
+
+    def build_graph_from_sim(self,
+                             similarity_matrix: np.ndarray,
+                             labels: List[str],
+                             source_documents: List[str],
+                             similarity_threshold: float = 0.7
+                            ) -> Optional[Tuple[nx.Graph, Dict[str, Any], Optional[List[Set[str]]]]]:
+        """
+        Builds the semantic graph from a precomputed cosine similarity matrix.
+        Only the edge filter depends on the threshold, so callers can reuse one matrix across threshold changes.
+
+        Returns:
+            The same (graph, metrics, communities) tuple as create_semantic_graph.
+        """
+        num_items = len(labels)
+        if similarity_matrix is None or similarity_matrix.shape != (num_items, num_items):
+            print("Error [build_graph_from_sim]: Sim matrix shape mismatch.")
+            return None, None, None
+
+        # Only the upper triangle (i < j) is thresholded, one row block at a time (no N x N masked copy)
+        block = self.SIMILARITY_BLOCK_ROWS
+        tiles = ((i0, similarity_matrix[i0:i0 + block, i0:]) for i0 in range(0, num_items, block))
+        rows_idx, cols_idx, edge_scores = self._upper_pairs_above(tiles, similarity_threshold)
+        return self.build_graph_from_pairs(rows_idx, cols_idx, edge_scores,
+                                           labels, source_documents, similarity_threshold)
+
+    def build_graph_from_pairs(self,
+                               rows_idx: np.ndarray,
+                               cols_idx: np.ndarray,
+                               edge_scores: np.ndarray,
+                               labels: List[str],
+                               source_documents: List[str],
+                               similarity_threshold: float = 0.7
+                              ) -> Optional[Tuple[nx.Graph, Dict[str, Any], Optional[List[Set[str]]]]]:
+        """Builds the graph, metrics and communities from above-threshold index pairs (i < j) and their similarities."""
+        num_items = len(labels)
 
         # Create color map for documents
-        unique_docs = sorted(list(set(source_documents)))
+        unique_docs = list(dict.fromkeys(source_documents)) # O(N), first-seen (document) order
         num_docs = len(unique_docs)
         doc_color_map = {} # Initialize
         try:
@@ -240,27 +589,34 @@ class AnalysisService:
                  print(f"Error adding node {label}: {node_add_error}")
                  G.add_node(label, index=i) # Add basic node on error
 
-        # Add edges based on threshold
-        edge_count = 0
-        for i in range(num_items):
-            for j in range(i + 1, num_items):
-                similarity = similarity_matrix[i, j]
-                if float(similarity) >= similarity_threshold:
-                    score = float(similarity)
-                    G.add_edge(labels[i], labels[j],
-                               weight=round(score, 4),
-                               label=f"{score:.2f}", # Label for Graphviz edge
-                               fontsize=8) # For Graphviz edge
-                    edge_count +=1
+        # Add edges that passed the threshold
+        edge_scores = np.asarray(edge_scores, dtype=float)
+        G.add_edges_from(
+            (labels[i], labels[j], {'weight': round(score, 4),
+                                    'label': f"{score:.2f}", # Label for Graphviz edge
+                                    'fontsize': 8}) # For Graphviz edge
+            for i, j, score in zip(rows_idx.tolist(), cols_idx.tolist(), edge_scores.tolist())
+        )
+        edge_count = len(edge_scores)
 
         # Calculate node degrees
         degrees = dict(G.degree())
         print(f"Calculated degrees for {len(degrees)} nodes.")
 
+        ig_graph = None
+        if igraph is not None:
+            # Same node order as G (node i is labels[i]), built straight from the edge index pairs
+            ig_graph = igraph.Graph(n=num_items, edges=list(zip(rows_idx.tolist(), cols_idx.tolist())), directed=False)
+
         try:
              print("Calculating betweenness centrality...")
              # Calculate unweighted betweenness for simplicity first
-             betweenness = nx.betweenness_centrality(G, normalized=True, endpoints=False)
+             if ig_graph is not None:
+                 # igraph counts each unordered pair once; rescale to NetworkX's normalized=True convention
+                 scale = 2.0 / ((num_items - 1) * (num_items - 2)) if num_items > 2 else 1.0
+                 betweenness = {label: bw * scale for label, bw in zip(labels, ig_graph.betweenness(directed=False))}
+             else:
+                 betweenness = nx.betweenness_centrality(G, normalized=True, endpoints=False)
              print(f"Calculated betweenness for {len(betweenness)} nodes.")
         except Exception as e:
              print(f"Error calculating betweenness centrality: {e}")
@@ -276,10 +632,18 @@ class AnalysisService:
         communities_list = [] # Initialize
         try:
              print("Detecting communities using Louvain method...")
-             # Pass the graph G, use weight=None for unweighted, or 'weight' if desired
-             detected_communities_sets = nx.community.louvain_communities(G, weight=None, seed=42)
-             # Convert frozensets to regular sets of strings (node labels)
-             communities_list = [set(community_fset) for community_fset in detected_communities_sets]
+             if ig_graph is not None:
+                 # community_multilevel is Louvain; membership[i] is the community of labels[i]
+                 membership = ig_graph.community_multilevel().membership
+                 communities_by_id = {}
+                 for label, community_id in zip(labels, membership):
+                     communities_by_id.setdefault(community_id, set()).add(label)
+                 communities_list = list(communities_by_id.values())
+             else:
+                 # Pass the graph G, use weight=None for unweighted, or 'weight' if desired
+                 detected_communities_sets = nx.community.louvain_communities(G, weight=None, seed=42)
+                 # Convert frozensets to regular sets of strings (node labels)
+                 communities_list = [set(community_fset) for community_fset in detected_communities_sets]
              print(f"Detected {len(communities_list)} communities.")
         except ImportError: # This might catch if python-louvain is not found by networkx
             print("Warning: Community detection may require 'python-louvain'. Please ensure it's installed (`pip install python-louvain`). Skipping community detection.")
@@ -1,8 +1,15 @@
 from sentence_transformers import SentenceTransformer
 import numpy as np
+from typing import List
+
+try:
+    import torch # Installed alongside sentence-transformers; only used for inference_mode
+except ImportError:
+    torch = None
 
 class EmbeddingService:
     """Handles the generation of text embeddings using a pre-trained model."""
+    DEFAULT_BATCH_SIZE = 64 # Texts per forward pass in generate_embeddings
 
     def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
         """Initializes the EmbeddingService by loading the specified model."""
@@ -35,4 +42,28 @@ class EmbeddingService:
             # Handle potential errors during the encoding process
             print(f"Error generating embedding for text: '{text[:50]}...': {e}")
             # Re-raise or return a specific error indicator/value
-            raise 
\ No newline at end of file
+            raise
+
+    def generate_embeddings(self, texts: List[str], batch_size: int = DEFAULT_BATCH_SIZE) -> np.ndarray:
+        """Generates embeddings for a list of texts in batched forward passes; returns an (n_texts, dim) array."""
+        if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+            raise TypeError("Input texts must be a list of strings.")
+        embedding_dimension = self.model.get_sentence_embedding_dimension()
+        embeddings = np.zeros((len(texts), embedding_dimension), dtype=np.float32)
+        # Empty strings keep their zero vector, matching generate_embedding
+        non_empty_indices = [i for i, t in enumerate(texts) if t]
+        if not non_empty_indices:
+            return embeddings
+
+        try:
+            non_empty_texts = [texts[i] for i in non_empty_indices]
+            if torch is not None:
+                with torch.inference_mode():
+                    encoded = self.model.encode(non_empty_texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+            else:
+                encoded = self.model.encode(non_empty_texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+            embeddings[non_empty_indices] = np.asarray(encoded)
+            return embeddings
+        except Exception as e:
+            print(f"Error generating batched embeddings for {len(texts)} texts: {e}")
+            raise
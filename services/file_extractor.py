@@ -0,0 +1,50 @@
+from typing import Optional, Tuple
+import io
+from PyPDF2 import PdfReader # Corrected capitalization
+
+try:
+    import pypdfium2 as pdfium # Much faster PDF text extraction; PyPDF2 remains the fallback
+except ImportError:
+    pdfium = None
+
+# Functions here are module-level (and take plain bytes) so they can run in a ProcessPoolExecutor worker.
+
+def extract_pdf_text(data: bytes, name: str = "") -> str:
+    """Extracts the text of a PDF given its raw bytes, trying pypdfium2 first and PyPDF2 second."""
+    text = ""
+    if pdfium is not None:
+        try:
+            with pdfium.PdfDocument(data) as pdf:
+                text = "\n".join(page.get_textpage().get_text_range() for page in pdf)
+        except Exception as pdfium_e: # e.g. password-protected or malformed; retry with PyPDF2
+            print(f"pypdfium2 failed on '{name}', falling back to PyPDF2: {pdfium_e}")
+            text = ""
+    if not text.strip():
+        reader = PdfReader(io.BytesIO(data))
+        parts = []
+        for page in reader.pages:
+            page_text = page.extract_text() # Extract once per page; it is the slowest step of ingestion
+            if page_text:
+                parts.append(page_text)
+        text = "".join(parts)
+    return text
+
+def extract_text(name: str, mime: str, data: bytes) -> Tuple[str, Optional[str], Optional[str]]:
+    """
+    Extracts text from an uploaded file's raw bytes.
+
+    Returns:
+        A tuple (name, text, error); text is None and error holds a user-facing message on failure.
+    """
+    try:
+        if mime == 'application/pdf':
+            text = extract_pdf_text(data, name)
+            if not text:
+                return name, None, f"Could not extract text from PDF '{name}'. Skipping."
+        elif mime == 'text/plain':
+            text = data.decode("utf-8")
+        else:
+            return name, None, f"Unsupported file type: {mime} for '{name}'"
+        return name, text, None
+    except Exception as e:
+        return name, None, f"Error processing file '{name}': {e}"
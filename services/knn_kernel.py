@@ -0,0 +1,143 @@
+from typing import Tuple
+import numpy as np
+
+try:
+    from numba import njit # Already installed as a dependency of umap-learn
+except ImportError:
+    njit = None
+
+# Fused "centroid of the selection -> cosine 1-NN over a row-normalised corpus" kernel.
+# Items whose similarity to the centroid is within self_atol of 1.0 are skipped, as in find_k_nearest.
+
+def _centroid_argmax_numpy(vectors: np.ndarray, corpus_norm: np.ndarray, self_atol: float) -> Tuple[int, float]:
+    """NumPy fallback: in-place centroid, one GEMV, masked argmax."""
+    query = np.array(vectors[0], dtype=np.float32)
+    for vec in vectors[1:]:
+        np.add(query, vec, out=query)
+    norm = np.sqrt(np.vdot(query, query)) # Cheaper than np.linalg.norm for a single vector
+    if norm == 0.0:
+        return -1, -1.0
+    query /= norm
+    scores = corpus_norm @ query
+    scores[scores >= 1.0 - self_atol] = -np.inf
+    best = int(np.argmax(scores))
+    if not np.isfinite(scores[best]):
+        return -1, -1.0
+    return best, float(scores[best])
+
+if njit is not None:
+    # Serial: parallel=True depends on Numba's threading layer, which breaks when called from Streamlit's script threads
+    @njit(cache=True, fastmath=True)
+    def _centroid_argmax_numba(vectors, corpus_norm, self_atol):
+        n_vectors, dim = vectors.shape
+        query = np.zeros(dim, dtype=np.float32)
+        for v in range(n_vectors):
+            for d in range(dim):
+                query[d] += vectors[v, d]
+        sq_norm = 0.0
+        for d in range(dim):
+            sq_norm += query[d] * query[d]
+        if sq_norm == 0.0:
+            return -1, -1.0
+        inv_norm = 1.0 / np.sqrt(sq_norm)
+        for d in range(dim):
+            query[d] *= inv_norm
+        n_items = corpus_norm.shape[0]
+        scores = np.empty(n_items, dtype=np.float32)
+        for i in range(n_items):
+            s = 0.0
+            for d in range(dim):
+                s += corpus_norm[i, d] * query[d]
+            scores[i] = s
+        # Argmax over the precomputed scores
+        best_i, best_s = -1, -1.0
+        for i in range(n_items):
+            if scores[i] < 1.0 - self_atol and (best_i < 0 or scores[i] > best_s):
+                best_i, best_s = i, scores[i]
+        return best_i, best_s
+else:
+    _centroid_argmax_numba = None
+
+def _pair_cosine_numpy(a: np.ndarray, b: np.ndarray) -> float:
+    """NumPy fallback: dot product over the product of norms; 0.0 if either vector is zero."""
+    denom = np.sqrt(np.vdot(a, a) * np.vdot(b, b))
+    return float(np.vdot(a, b) / denom) if denom > 0.0 else 0.0
+
+if njit is not None:
+    @njit('f8(f4[::1], f4[::1])', cache=True, fastmath=True)
+    def _pair_cosine_numba(a, b):
+        dot = 0.0
+        sq_a = 0.0
+        sq_b = 0.0
+        for d in range(a.shape[0]):
+            dot += a[d] * b[d]
+            sq_a += a[d] * a[d]
+            sq_b += b[d] * b[d]
+        if sq_a == 0.0 or sq_b == 0.0:
+            return 0.0
+        return dot / np.sqrt(sq_a * sq_b)
+else:
+    _pair_cosine_numba = None
+
+def pair_cosine(a: np.ndarray, b: np.ndarray) -> float:
+    """Cosine similarity of two 1-D vectors in one fused pass (no sklearn validation per call); 0.0 for a zero vector."""
+    a = np.ascontiguousarray(a, dtype=np.float32)
+    b = np.ascontiguousarray(b, dtype=np.float32)
+    if _pair_cosine_numba is not None:
+        return float(_pair_cosine_numba(a, b))
+    return _pair_cosine_numpy(a, b)
+
+def _query_cosine_numpy(query: np.ndarray, corpus: np.ndarray) -> np.ndarray:
+    """NumPy fallback: one GEMV divided by the row norms; zero rows and a zero query score 0.0."""
+    denom = np.sqrt(np.einsum('ij,ij->i', corpus, corpus) * np.vdot(query, query))
+    scores = corpus @ query
+    np.divide(scores, denom, out=scores, where=denom > 0.0) # Where denom is 0 the dot product is already 0
+    return scores
+
+if njit is not None:
+    # Serial for the same reason as _centroid_argmax_numba; the eager signature would compile a parallel kernel at import
+    @njit('f4[::1](f4[::1], f4[:, ::1])', cache=True, fastmath=True)
+    def _query_cosine_numba(query, corpus):
+        dim = query.shape[0]
+        sq_q = 0.0
+        for d in range(dim):
+            sq_q += query[d] * query[d]
+        n_items = corpus.shape[0]
+        scores = np.zeros(n_items, dtype=np.float32)
+        if sq_q == 0.0:
+            return scores
+        for i in range(n_items):
+            dot = 0.0
+            sq_row = 0.0
+            for d in range(dim):
+                dot += corpus[i, d] * query[d]
+                sq_row += corpus[i, d] * corpus[i, d]
+            if sq_row > 0.0:
+                scores[i] = dot / np.sqrt(sq_row * sq_q)
+        return scores
+else:
+    _query_cosine_numba = None
+
+def query_cosine(query: np.ndarray, corpus: np.ndarray) -> np.ndarray:
+    """Cosine similarity of one query against every row of an unnormalised corpus, fusing the row norms into the scan (no normalised corpus copy)."""
+    query = np.ascontiguousarray(query, dtype=np.float32).ravel()
+    corpus = np.ascontiguousarray(corpus, dtype=np.float32)
+    if _query_cosine_numba is not None:
+        return _query_cosine_numba(query, corpus)
+    return _query_cosine_numpy(query, corpus)
+
+def centroid_argmax(vectors: np.ndarray, corpus_norm: np.ndarray, self_atol: float = 1e-5) -> Tuple[int, float]:
+    """
+    Returns (index, cosine similarity) of the corpus row nearest to the centroid of vectors.
+
+    Args:
+        vectors: (m, dim) selected embeddings.
+        corpus_norm: (n, dim) C-contiguous float32 corpus with L2-normalised rows.
+    Returns:
+        (-1, -1.0) if the centroid is zero or every item matches it exactly.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if _centroid_argmax_numba is not None:
+        best_i, best_s = _centroid_argmax_numba(vectors, corpus_norm, np.float32(self_atol))
+        return int(best_i), float(best_s)
+    return _centroid_argmax_numpy(vectors, corpus_norm, self_atol)
@@ -3,13 +3,17 @@ import streamlit as st
 import numpy as np
 import os
 import io # Added io
+import hashlib
+import tempfile
+import heapq
 import pandas as pd # Added pandas import
 from typing import List, Tuple, Optional
-from PyPDF2 import PdfReader # Corrected capitalization
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import networkx as nx # Import networkx
 import plotly.express as px # Add import for colors
+import plotly.io as pio
 import streamlit.components.v1 as components # Import Streamlit components
-import graphviz # <<< Add graphviz import
 
 # --- Path Setup for Sibling Module Imports ---
 import sys
@@ -28,6 +32,7 @@ from models.document import Document
 from models.chunk import Chunk
 from services.ai.embedding_service import EmbeddingService
 from services.ai.analysis_service import AnalysisService
+from services.file_extractor import extract_text
 from visualization.scatter_plotter import VisualizationService
 from services.ai.text_processor import ContextualChunker
 
@@ -35,6 +40,12 @@ from services.ai.text_processor import ContextualChunker
 # SAMPLE_DOCS removed for brevity, assume they exist if needed later
 DEFAULT_K = 3
 MIN_ITEMS_FOR_PLOT = 4 # Minimum items (Docs/Chunks) needed for a meaningful plot
+MAX_CHUNKS_FOR_SIM_MATRIX = 5000 # Cache the N x N chunk similarity table up to this size (~100 MB float32)
+MAX_COMMUNITIES_SHOWN = 50 # Community expanders rendered for the semantic graph
+MAX_GRAPH_NODES_RENDERED = 150 # Larger graphs are thinned (k-core / top degree) before drawing
+HEATMAP_DETAIL_SIDE = 64 # Side of the full-resolution block shown under the block-mean similarity overview
+EMBEDDING_CACHE_DIR = os.path.join(_project_root, 'cache') # Memory-mapped corpus matrices, named by content digest
+EMBEDDING_STORE_DIR = os.path.join(EMBEDDING_CACHE_DIR, 'embeddings') # One float16 .npy per embedded text, named by sha256
 
 # --- Service Initialization with Caching ---
 # Use st.cache_resource to load models/services only once
@@ -66,24 +77,161 @@ def load_chunker(_embedding_service, _analysis_service):
         st.error(f"Error loading Contextual Chunker: {e}")
         return None
 
+@st.cache_resource
+def get_extraction_pool():
+    """Process pool for CPU-bound file text extraction, created once per server."""
+    return ProcessPoolExecutor(max_workers=os.cpu_count())
+
+@st.cache_resource
+def get_similarity_executor():
+    """Single background thread for large similarity builds; BLAS releases the GIL, so the script thread stays responsive."""
+    return ThreadPoolExecutor(max_workers=1)
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _extract_text_cached(content_hash: str, name: str, mime: str, _raw: bytes) -> str:
+    """Extracts one upload in the process pool; keyed by (content hash, name, mime) so re-uploads skip parsing.
+
+    Raises instead of returning an error, so failures are never cached and a re-upload retries them.
+    """
+    for attempt in range(2):
+        pool = get_extraction_pool()
+        try:
+            _, text, error = pool.submit(extract_text, name, mime, _raw).result()
+            break
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed on a huge PDF), which breaks the cached pool for good: replace it,
+            # then retry once, since this file may only have been queued behind the one that killed the worker
+            if get_extraction_pool() is pool:
+                get_extraction_pool.clear()
+            pool.shutdown(wait=False)
+            if attempt:
+                raise
+    if error:
+        raise ValueError(error)
+    return text
+
+def extract_upload(content_hash: str, name: str, mime: str, raw: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """Returns (text, None) for an extracted upload or (None, user-facing error)."""
+    try:
+        return _extract_text_cached(content_hash, name, mime, raw), None
+    except ValueError as e: # extract_text's own message
+        return None, str(e)
+    except Exception as e: # e.g. the worker process died
+        return None, f"Error processing file '{name}': {e}"
+
 embedding_service = load_embedding_service()
 analysis_service = load_analysis_service()
 visualization_service = load_visualization_service()
 chunker = load_chunker(embedding_service, analysis_service)
 
+def save_npy_atomic(path: str, array: np.ndarray) -> None:
+    """Writes array to path via a uniquely named temp file in the same directory, so concurrent writers never collide and readers never see a partial file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as f:
+        np.save(f, array)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+@st.cache_resource
+def get_embedding_memo() -> dict:
+    """Process-wide content hash -> float16 embedding, in front of the per-text files in cache/embeddings."""
+    return {}
+
+def _load_cached_embedding(text_hash: str) -> Optional[np.ndarray]:
+    """The stored embedding of one text (by sha256), or None if it has never been embedded."""
+    memo = get_embedding_memo()
+    embedding = memo.get(text_hash)
+    if embedding is None:
+        try:
+            embedding = memo[text_hash] = np.load(os.path.join(EMBEDDING_STORE_DIR, f"{text_hash}.npy"))
+        except (OSError, ValueError):
+            return None
+    return embedding
+
+def _store_embeddings(text_hashes: List[str], embeddings: np.ndarray) -> None:
+    """Saves each new embedding under its own content hash as float16 (half the disk I/O)."""
+    memo = get_embedding_memo()
+    for text_hash, embedding in zip(text_hashes, embeddings.astype(np.float16)):
+        memo[text_hash] = embedding
+        try:
+            save_npy_atomic(os.path.join(EMBEDDING_STORE_DIR, f"{text_hash}.npy"), embedding)
+        except OSError as e:
+            print(f"Warning: could not store embedding {text_hash[:12]} in {EMBEDDING_STORE_DIR}: {e}")
+
+@st.cache_data(persist="disk", show_spinner=False, max_entries=8)
+def reduce_dimensions_cached(matrix_key: str, _embeddings: np.ndarray, n_components: int) -> Optional[np.ndarray]:
+    """UMAP projection memoized on the embedding matrix digest, so toggling 2D/3D views does not refit (or rehash the matrix).
+
+    The digest is content-derived, so the on-disk copy also lets new sessions over the same corpus skip the fit.
+    """
+    return analysis_service.reduce_dimensions(np.asarray(_embeddings, dtype=np.float32), n_components=n_components) # float16 chunk matrix upcast here
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embeds texts, embedding identical content once and reusing the on-disk content-hash cache."""
+    hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+    unique_rows = {} # content hash -> row in the deduplicated batch (insertion ordered)
+    unique_texts = []
+    for text_hash, text in zip(hashes, texts):
+        if text_hash not in unique_rows:
+            unique_rows[text_hash] = len(unique_texts)
+            unique_texts.append(text)
+    # Per-text lookups, then one batched model call for the misses only: editing one document re-embeds just its texts
+    unique_hashes = list(unique_rows)
+    cached = [_load_cached_embedding(text_hash) for text_hash in unique_hashes]
+    missing = [row for row, embedding in enumerate(cached) if embedding is None]
+    if missing:
+        new_embeddings = np.asarray(embedding_service.generate_embeddings([unique_texts[row] for row in missing]))
+        _store_embeddings([unique_hashes[row] for row in missing], new_embeddings)
+        for row in missing:
+            cached[row] = get_embedding_memo()[unique_hashes[row]] # The float16 copy just stored
+    unique_embeddings = np.stack(cached) if cached else np.empty((0, 0), dtype=np.float16)
+    return unique_embeddings[[unique_rows[text_hash] for text_hash in hashes]].astype(np.float32)
+
 # --- Session State Initialization ---
 def initialize_session_state():
     defaults = {
         'documents': [],
+        'documents_by_title': {}, # title -> Document, kept in sync with 'documents' for O(1) dedup/lookup
+        'document_hashes': set(), # sha256 of uploaded file bytes, to skip identical files under new names
         'embeddings_generated': False,
-        'all_chunk_embeddings_matrix': None,
+        'all_chunk_embeddings_matrix': None, # float16 (n_chunks, dim): plotting input and row source for centroid/KNN queries
         'all_chunk_labels': [],
         'chunk_label_lookup_dict': {},
+        'all_chunk_doc_idx': None, # int32 row -> index of the chunk's document in 'documents' (row-aligned with the matrix)
+        'all_chunk_source_titles': [], # row -> source document title, for plot/graph coloring without label lookups
         'analysis_level': 'Documents',
         'scatter_fig_2d': None,
         'current_coords_2d': None,
         'current_labels': [],
         'coords_3d': None,
+        'doc_has_embed': {}, # doc.id -> True once its document embedding exists
+        'doc_matrix': None, # (n_docs_with_embeddings, dim) float32, rows aligned with 'doc_titles'
+        'doc_titles': [],
+        'doc_title_to_index': {}, # title -> row in 'doc_matrix'
+        'doc_matrix_key': None, # tuple of doc ids the cached 'doc_matrix' was built from
+        'doc_matrix_norm': None, # Row-normalised 'doc_matrix' for single-GEMV cosine KNN
+        'doc_matrix_digest': None, # blake2b digest of 'doc_matrix', keys cached centroid queries
+        'all_chunk_embeddings_matrix_norm': None, # Row-normalised chunk matrix, same purpose
+        'all_chunk_embeddings_matrix_i8': None, # int8-quantised chunk matrix for the KNN candidate scan
+        'chunk_sim_matrix': None, # N x N chunk cosine similarities, for table lookups instead of per-query GEMVs
+        'chunk_matrix_key': None, # blake2b digest of 'all_chunk_embeddings_matrix', keys the cached semantic graph
+        'chunk_sim_matrix_key': None, # 'chunk_matrix_key' the cached 'chunk_sim_matrix' was computed from
+        'show_sim_matrix_info': False, # Keeps the matrices-info results visible across reruns once requested
+        'sim_matrix_job': None, # (chunk_matrix_key, Future) for a similarity matrix built off the script thread
+        'doc_chunk_embed_counts': {}, # doc.id -> number of embedded chunks
+        'docs_version': 0, # Bumped by upload, chunking, embedding and reset; keys the document-derived memos below
+        'doc_summary_rows': [], # Rows of the loaded-documents table, rebuilt only when 'doc_summary_key' changes
+        'doc_summary_key': None,
+        'doc_color_map': {}, # doc title -> plot color, rebuilt once per embedding run
+        'structure_table': None, # Styled chunk-overview table, rebuilt only when 'structure_table_key' changes
+        'structure_table_key': None,
+        'embedded_docs': [], # Documents with an embedding, rebuilt only when 'embedded_docs_key' changes
+        'embedded_docs_by_title': {}, # title -> Document for 'embedded_docs'
+        'embedded_docs_key': None,
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -92,15 +240,17 @@ def initialize_session_state():
 initialize_session_state()
 
 # --- Helper Functions ---
-def reset_derived_data(clear_docs=False):
-    """Clears embeddings, chunks, derived data. Optionally clears documents too."""
+def reset_derived_data(clear_docs=False, clear_chunks=True):
+    """Clears embeddings, chunks, derived data. Optionally clears documents too, or keeps freshly made chunks."""
     if clear_docs:
         st.session_state.documents = []
+        st.session_state.documents_by_title = {}
+        st.session_state.document_hashes = set()
     else:
         # Only clear derived data from docs if keeping them
         for doc in st.session_state.documents:
             doc.embedding = None
-            if hasattr(doc, 'chunks'):
+            if clear_chunks:
                 doc.chunks = []
 
     # Reset all derived state regardless
@@ -110,10 +260,230 @@ def reset_derived_data(clear_docs=False):
     st.session_state.all_chunk_embeddings_matrix = None
     st.session_state.all_chunk_labels = []
     st.session_state.chunk_label_lookup_dict = {}
+    st.session_state.all_chunk_doc_idx = None
+    st.session_state.all_chunk_source_titles = []
     st.session_state.analysis_level = 'Documents' # Default level
     st.session_state.scatter_fig_2d = None
     st.session_state.current_coords_2d = None
     st.session_state.current_labels = []
+    st.session_state.doc_has_embed = {}
+    st.session_state.doc_matrix = None
+    st.session_state.doc_titles = []
+    st.session_state.doc_title_to_index = {}
+    st.session_state.doc_matrix_key = None
+    st.session_state.doc_matrix_norm = None
+    st.session_state.doc_matrix_digest = None
+    st.session_state.all_chunk_embeddings_matrix_norm = None
+    st.session_state.all_chunk_embeddings_matrix_i8 = None
+    st.session_state.chunk_sim_matrix = None
+    st.session_state.chunk_matrix_key = None
+    st.session_state.chunk_sim_matrix_key = None
+    st.session_state.show_sim_matrix_info = False
+    st.session_state.sim_matrix_job = None
+    st.session_state.doc_chunk_embed_counts = {}
+    st.session_state.doc_color_map = {}
+    bump_docs_version() # Invalidates the summary rows, embedded-doc list and structure table
+
+
+def bump_docs_version():
+    """Marks the documents, their chunks or their embeddings as changed."""
+    st.session_state.docs_version += 1
+
+def stack_embeddings(items) -> np.ndarray:
+    """Copies the .embedding of each item into one preallocated (n, dim) float32 matrix."""
+    matrix = np.empty((len(items), items[0].embedding.shape[-1] if items else 0), dtype=np.float32)
+    for i, item in enumerate(items):
+        matrix[i] = item.embedding
+    return matrix
+
+def get_doc_corpus(docs_with_embeddings, normalized: bool = False) -> Tuple[Optional[np.ndarray], List[str]]:
+    """Returns the cached document matrix (or its row-normalised copy) and titles, rebuilding only when the embedded document set changed."""
+    key = tuple(doc.id for doc in docs_with_embeddings)
+    if st.session_state.get('doc_matrix_key') != key:
+        st.session_state.doc_matrix = stack_embeddings(docs_with_embeddings) if docs_with_embeddings else None
+        st.session_state.doc_matrix_norm = analysis_service.normalize_rows(st.session_state.doc_matrix) if docs_with_embeddings else None
+        st.session_state.doc_titles = [doc.title for doc in docs_with_embeddings]
+        st.session_state.doc_title_to_index = {title: i for i, title in enumerate(st.session_state.doc_titles)}
+        st.session_state.doc_matrix_key = key
+        st.session_state.doc_matrix_digest = hashlib.blake2b(st.session_state.doc_matrix.tobytes(), digest_size=16).hexdigest() if docs_with_embeddings else None
+    matrix = st.session_state.doc_matrix_norm if normalized else st.session_state.doc_matrix
+    return matrix, st.session_state.doc_titles
+
+def share_matrix_on_disk(matrix: np.ndarray, name: str, digest: str) -> np.ndarray:
+    """Saves matrix once as cache/<name>_<digest>.npy and returns a read-only memory map of it.
+
+    Reruns, sessions and worker processes opening the same digest share one set of page-cache pages.
+    Only the newest digest per name is kept on disk. Falls back to the in-memory array if the cache directory is not writable.
+    """
+    path = os.path.join(EMBEDDING_CACHE_DIR, f"{name}_{digest}.npy")
+    try:
+        if not os.path.exists(path):
+            save_npy_atomic(path, np.ascontiguousarray(matrix, dtype=np.float32))
+            # Evict stale digests; maps already open on them stay valid until closed
+            prefix = f"{name}_"
+            for entry in os.listdir(EMBEDDING_CACHE_DIR):
+                if entry.startswith(prefix) and entry.endswith('.npy') and entry != os.path.basename(path):
+                    try:
+                        os.remove(os.path.join(EMBEDDING_CACHE_DIR, entry))
+                    except OSError:
+                        pass # e.g. still mapped on Windows; retried on the next save
+        return np.load(path, mmap_mode='r')
+    except OSError as e:
+        print(f"Warning: could not memory-map '{name}' from {EMBEDDING_CACHE_DIR}: {e}")
+        return matrix
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def similarity_matrix_cached(matrix_key: str, _matrix_norm: np.ndarray) -> Optional[np.ndarray]:
+    """Chunk cosine similarity matrix keyed on the embedding matrix digest; shared across reruns and sessions."""
+    # Rows are already unit-length, so this is just the tiled SGEMM
+    return analysis_service.calculate_similarity_matrix(_matrix_norm, pre_normalized=True)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def get_knn_index(matrix_key: str, _corpus_norm: np.ndarray):
+    """FAISS index for one row-normalised corpus (keyed by its digest), built once and shared across reruns and sessions."""
+    return analysis_service.build_knn_index(_corpus_norm)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def similarity_heatmap_json(matrix_key: str, _sim_matrix: np.ndarray) -> str:
+    """Serialised overview heatmap for the similarity matrix of one chunk matrix digest; reruns skip the figure build."""
+    return visualization_service.plot_similarity_heatmap(_sim_matrix).to_json()
+
+def get_chunk_sim_matrix() -> Optional[np.ndarray]:
+    """Returns the cached chunk cosine similarity matrix, (re)computing it only if the chunk matrix changed; None if too large."""
+    chunk_matrix_norm = st.session_state.get('all_chunk_embeddings_matrix_norm')
+    n_chunks = len(st.session_state.get('all_chunk_labels', []))
+    if chunk_matrix_norm is None or n_chunks == 0 or n_chunks > MAX_CHUNKS_FOR_SIM_MATRIX:
+        return None
+    sim_matrix = st.session_state.get('chunk_sim_matrix')
+    matrix_key = st.session_state.get('chunk_matrix_key')
+    if sim_matrix is None or sim_matrix.shape[0] != n_chunks or st.session_state.get('chunk_sim_matrix_key') != matrix_key:
+        sim_matrix = similarity_matrix_cached(matrix_key, chunk_matrix_norm)
+        st.session_state.chunk_sim_matrix = sim_matrix
+        st.session_state.chunk_sim_matrix_key = matrix_key
+    return sim_matrix
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def centroid_nearest_cached(selected_rows: Tuple[int, ...], corpus_digest: str, _matrix: np.ndarray, _corpus_norm: np.ndarray,
+                            _similarity_matrix: Optional[np.ndarray] = None) -> Tuple[Optional[int], Optional[float]]:
+    """(index, score) of the item nearest the centroid of the selected rows; repeat selections on the same corpus are free."""
+    if _similarity_matrix is not None: # Table lookup, weighted by the selected raw row norms so both paths share one centroid
+        selected = _matrix[list(selected_rows)].astype(np.float32)
+        selected_norms = np.sqrt(np.einsum('ij,ij->i', selected, selected))
+        return analysis_service.find_centroid_nearest_from_similarity(_similarity_matrix, list(selected_rows), selected_norms)
+    return analysis_service.find_centroid_nearest(_matrix[list(selected_rows)], _corpus_norm)
+
+def poll_background_sim_matrix() -> Tuple[Optional[np.ndarray], bool]:
+    """Returns (matrix, pending) for a similarity matrix too large for the session cache, built on the background thread."""
+    matrix_key = st.session_state.get('chunk_matrix_key')
+    job = st.session_state.get('sim_matrix_job')
+    if job is None or job[0] != matrix_key: # First request, or embeddings changed since the last build
+        future = get_similarity_executor().submit(
+            analysis_service.calculate_similarity_matrix, st.session_state.get('all_chunk_embeddings_matrix_norm'), True
+        )
+        job = st.session_state.sim_matrix_job = (matrix_key, future)
+    if not job[1].done():
+        return None, True
+    return job[1].result(), False
+
+@st.fragment(run_every=1.0)
+def wait_for_sim_matrix_job():
+    """Polls the background similarity build once a second and reruns the page when it finishes."""
+    job = st.session_state.get('sim_matrix_job')
+    if job is None or job[1].done():
+        st.rerun()
+    st.info("Computing the similarity matrix in the background; the rest of the page stays usable.")
+
+@st.cache_resource(show_spinner=False)
+def build_color_map(labels: Tuple[str, ...]) -> dict:
+    """Maps each unique label (in first-seen order) to a color from the Plotly qualitative palette."""
+    unique_titles = dict.fromkeys(labels) # O(N) dedupe; document order is already deterministic, so no sort is needed
+    color_sequence = px.colors.qualitative.Plotly
+    return {title: color_sequence[i % len(color_sequence)] for i, title in enumerate(unique_titles)}
+
+@st.cache_data(show_spinner=False)
+def build_semantic_graph_cached(matrix_key: str, labels: Tuple[str, ...], source_documents: Tuple[str, ...], threshold: float,
+                                _embeddings: np.ndarray, _similarity_matrix: Optional[np.ndarray]):
+    """Semantic graph, metrics and communities for one (embedding matrix, threshold); reruns and re-clicks skip betweenness/Louvain."""
+    return analysis_service.create_semantic_graph(
+        _embeddings,
+        list(labels),
+        source_documents=list(source_documents),
+        similarity_threshold=threshold,
+        similarity_matrix=_similarity_matrix
+    )
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def graph_layout_cached(matrix_key: str, threshold: float, nodes: Tuple[str, ...], _graph: nx.Graph) -> dict:
+    """Spring layout of the drawn graph for one (embedding matrix, threshold, node set); re-clicks and reruns reuse the positions."""
+    return nx.spring_layout(_graph, seed=42)
+
+def get_doc_summary_rows() -> List[dict]:
+    """Rows for the loaded-documents table, memoised in session state until the documents or their embedding summaries change."""
+    docs = st.session_state.documents
+    doc_has_embed = st.session_state.doc_has_embed
+    doc_chunk_embed_counts = st.session_state.doc_chunk_embed_counts
+    summary_key = st.session_state.docs_version
+    if st.session_state.doc_summary_key != summary_key:
+        doc_rows = []
+        for i, doc in enumerate(docs):
+            # Document always carries a chunks list (empty until chunking yields something)
+            chunks_status = f"{len(doc.chunks)} ({doc_chunk_embed_counts.get(doc.id, 0)} embedded)" if doc.chunks else "0"
+            doc_rows.append({
+                "#": i + 1,
+                "Title": doc.title,
+                "Doc Embedding": "Yes" if doc_has_embed.get(doc.id) else "No",
+                "Chunks": chunks_status,
+            })
+        st.session_state.doc_summary_rows = doc_rows
+        st.session_state.doc_summary_key = summary_key
+    return st.session_state.doc_summary_rows
+
+def get_embedded_docs() -> Tuple[List[Document], dict]:
+    """Documents that have an embedding plus a title -> document map of them, memoised until the documents or their embeddings change."""
+    docs = st.session_state.documents
+    embedded_key = st.session_state.docs_version
+    if st.session_state.embedded_docs_key != embedded_key:
+        embedded_docs = [doc for doc in docs if doc.embedding is not None]
+        st.session_state.embedded_docs = embedded_docs
+        st.session_state.embedded_docs_by_title = {doc.title: doc for doc in embedded_docs}
+        st.session_state.embedded_docs_key = embedded_key
+    return st.session_state.embedded_docs, st.session_state.embedded_docs_by_title
+
+def get_structure_table():
+    """Styled chunk-overview table (one row per document, one column per chunk), memoised until the documents or color map change; None without chunks."""
+    docs = st.session_state.documents
+    doc_color_map = st.session_state.doc_color_map
+    table_key = st.session_state.docs_version # The color map is rebuilt by the embedding run, which bumps it too
+    if st.session_state.structure_table_key != table_key:
+        structure_table = None
+        max_chunks = max((len(doc.chunks) for doc in docs), default=0)
+        if max_chunks > 0:
+            # Preallocated object grid filled in place: no per-row lists to pad or schema for pandas to infer
+            cells = np.full((len(docs), max_chunks + 1), "", dtype=object)
+            for i, doc in enumerate(docs):
+                cells[i, 0] = doc.title
+                if doc.chunks:
+                    cells[i, 1:len(doc.chunks) + 1] = [chunk.context_label if chunk else "" for chunk in doc.chunks]
+                else:
+                    cells[i, 1:] = "-" # Placeholder for docs without chunks
+            df = pd.DataFrame(cells, columns=['Document'] + [f"Chunk {i+1}" for i in range(max_chunks)]) # Keep 'Document' as a column
+            # The CSS for the whole 'Document' column is precomputed and applied in one Styler.apply call
+            document_styles = [f'background-color: {doc_color_map[doc.title]}' if doc_color_map.get(doc.title) else '' for doc in docs]
+            structure_table = df.style.apply(lambda _column: document_styles, subset=['Document'])
+        st.session_state.structure_table = structure_table
+        st.session_state.structure_table_key = table_key
+    return st.session_state.structure_table
+
+def top_n_items(metric: dict, n: int, dtype) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the n (key, value) pairs of a node metric dict with the largest values, descending, via argpartition."""
+    keys = np.array(list(metric.keys()), dtype=object)
+    vals = np.fromiter(metric.values(), dtype=dtype, count=len(metric))
+    if vals.size > n:
+        idx = np.argpartition(-vals, n - 1)[:n] # O(N) selection; only these n are sorted
+    else:
+        idx = np.arange(vals.size)
+    idx = idx[np.argsort(-vals[idx], kind='stable')]
+    return keys[idx], vals[idx]
 
 
 # --- Streamlit App UI ---
@@ -132,46 +502,61 @@ uploaded_files = st.sidebar.file_uploader(
 if st.sidebar.button("Process Uploaded Files"):
     if uploaded_files:
         new_docs_added = []
-        current_doc_names = {doc.title for doc in st.session_state.documents}
+        documents_by_title = st.session_state.documents_by_title
+        pending_names = set() # Names queued in this batch, to skip duplicates within the upload itself
+        pending_hashes = set() # Same for content; document_hashes only gets a hash once its file extracted
         should_reset_derived = False
 
+        document_hashes = st.session_state.document_hashes
+        # Read bytes once on the main thread (UploadedFile is not picklable); reused for extraction, size and hash
+        pending_files = [] # (uploaded_file, raw bytes, content hash)
         for uploaded_file in uploaded_files:
-            if uploaded_file.name in current_doc_names:
+            if uploaded_file.name in documents_by_title or uploaded_file.name in pending_names:
                 st.sidebar.warning(f"Skipping '{uploaded_file.name}': Name already exists.")
                 continue
-
-            text = ""
-            try:
-                if uploaded_file.type == 'application/pdf':
-                    reader = PdfReader(uploaded_file)
-                    text = "".join(page.extract_text() for page in reader.pages if page.extract_text())
-                    if not text:
-                         st.sidebar.error(f"Could not extract text from PDF '{uploaded_file.name}'. Skipping.")
-                         continue
-                elif uploaded_file.type == 'text/plain':
-                    text = uploaded_file.getvalue().decode("utf-8")
-                else:
-                    st.sidebar.error(f"Unsupported file type: {uploaded_file.type} for '{uploaded_file.name}'")
+            raw = uploaded_file.getvalue()
+            content_hash = hashlib.sha256(raw).hexdigest()
+            if content_hash in document_hashes or content_hash in pending_hashes:
+                st.sidebar.warning(f"Skipping '{uploaded_file.name}': Identical content already loaded.")
+                continue
+            pending_names.add(uploaded_file.name)
+            pending_hashes.add(content_hash)
+            pending_files.append((uploaded_file, raw, content_hash))
+
+        extracted_texts = {}
+        if pending_files:
+            # One cached call per file, run concurrently so cache misses still parse in parallel in the process pool
+            with ThreadPoolExecutor(max_workers=len(pending_files)) as upload_threads:
+                extraction_results = list(upload_threads.map(
+                    lambda pending: extract_upload(pending[2], pending[0].name, pending[0].type, pending[1]), pending_files
+                ))
+            for (uploaded_file, _, _), (text, error) in zip(pending_files, extraction_results):
+                if error:
+                    st.sidebar.error(error)
                     continue
-
-                new_doc = Document(
-                    title=uploaded_file.name, content=text,
-                    metadata={'source': 'upload', 'type': uploaded_file.type, 'size': uploaded_file.size}
-                )
-                new_docs_added.append(new_doc)
-                current_doc_names.add(uploaded_file.name)
+                extracted_texts[uploaded_file.name] = text
                 st.sidebar.success(f"Processed '{uploaded_file.name}'")
-                should_reset_derived = True
 
-            except Exception as e:
-                st.sidebar.error(f"Error processing file '{uploaded_file.name}': {e}")
+        for uploaded_file, raw, content_hash in pending_files: # Keep upload order for the new documents
+            if uploaded_file.name not in extracted_texts:
+                continue # Hash not recorded, so the file may be retried
+            document_hashes.add(content_hash)
+            new_doc = Document(
+                title=uploaded_file.name, content=extracted_texts[uploaded_file.name],
+                metadata={'source': 'upload', 'type': uploaded_file.type, 'size': len(raw), 'content_hash': content_hash}
+            )
+            new_docs_added.append(new_doc)
+            should_reset_derived = True
 
         if new_docs_added:
             if should_reset_derived:
                  print("New documents added, resetting derived data (embeddings, plots, matrices).")
                  reset_derived_data(clear_docs=False)
 
-            st.session_state.documents = st.session_state.documents + new_docs_added
+            for new_doc in new_docs_added:
+                documents_by_title[new_doc.title] = new_doc
+            st.session_state.documents.extend(new_docs_added) # Append in place, no list re-copy
+            bump_docs_version()
             st.sidebar.info(f"Added {len(new_docs_added)} new documents.")
             st.rerun()
     else:
@@ -201,7 +586,6 @@ if st.sidebar.button("Chunk Loaded Documents", disabled=not chunker):
             with st.spinner("Chunking documents..."):
                 for doc in st.session_state.documents:
                     try: # <-- Indent Level 2 (Inner Try)
-                        if not hasattr(doc, 'chunks'): doc.chunks = []
                         doc.chunks = chunker.chunk_document(doc)
                         updated_documents.append(doc)
                     except Exception as e: # <-- Indent Level 2 (Matches Inner Try)
@@ -210,6 +594,8 @@ if st.sidebar.button("Chunk Loaded Documents", disabled=not chunker):
                          error_occurred = True
 
             st.session_state.documents = updated_documents # Update state inside try
+            st.session_state.doc_chunk_embed_counts = {} # New chunks carry no embeddings yet
+            bump_docs_version()
             msg = f"Chunking complete for {len(st.session_state.documents)} documents."
             if error_occurred:
                 st.sidebar.warning(msg + " (with errors)")
@@ -220,11 +606,10 @@ if st.sidebar.button("Chunk Loaded Documents", disabled=not chunker):
             st.sidebar.error(f"An unexpected error occurred during chunking: {e}")
             error_occurred = True # Ensure error is flagged if outer try fails
 
-            # Reset state and rerun AFTER try/except finishes
-            # Only reset embeddings if chunking didn't completely fail
-            if not error_occurred or updated_documents: # Avoid reset if initial error prevented any updates
-                 reset_derived_data(clear_docs=False)
-            st.rerun()
+        # Reset state AFTER try/except finishes; the main area below renders from it in this same run
+        # Only reset embeddings if chunking didn't completely fail
+        if not error_occurred or updated_documents: # Avoid reset if initial error prevented any updates
+             reset_derived_data(clear_docs=False, clear_chunks=False) # Drop the old chunk matrix/labels/index, keep the new chunks
 
     elif not chunker:
          st.sidebar.error("Chunking Service not available.")
@@ -241,72 +626,112 @@ if st.sidebar.button("Generate Embeddings", disabled=not embedding_service):
                 error_occurred = False
                 updated_documents = list(st.session_state.documents) # Work on a copy
 
-                for i, doc in enumerate(updated_documents):
-                    # 1. Process Document Embedding
-                    if doc.embedding is None:
-                        try:
-                            doc.embedding = embedding_service.generate_embedding(doc.content)
-                            if doc.embedding is not None: docs_processed_count += 1
-                        except Exception as e:
-                            st.sidebar.error(f"Error embedding doc '{doc.title}': {e}")
-                            error_occurred = True
-                            continue # Skip to next doc if doc embedding fails
-
-                    # 2. Process Chunk Embeddings (if chunks exist)
-                    if hasattr(doc, 'chunks') and doc.chunks:
-                        for chunk_idx, chunk in enumerate(doc.chunks):
-                            if chunk.embedding is None:
-                                try:
-                                    chunk.embedding = embedding_service.generate_embedding(chunk.content)
-                                    if chunk.embedding is not None: chunks_processed_count += 1
-                                except Exception as e:
-                                    st.sidebar.error(f"Error embedding chunk {chunk_idx} in doc '{doc.title}': {e}")
-                                    error_occurred = True
-                                    # Optionally, decide if you want to stop all embedding for this doc or continue with other chunks
-                    updated_documents[i] = doc # Update the document in the list
+                # 1. Collect every document and chunk still missing an embedding, so the model sees one
+                #    batched call (full batches across the doc/chunk boundary) instead of one per kind
+                pending_docs = [doc for doc in updated_documents if doc.embedding is None]
+                pending_chunks = [
+                    chunk for doc in updated_documents
+                    for chunk in doc.chunks if chunk.embedding is None
+                ]
+                pending_items = pending_docs + pending_chunks
+                if pending_items:
+                    try:
+                        item_matrix = embed_texts([item.content for item in pending_items])
+                        # 2. Scatter rows back. Per-object copies are float16 (half the session memory);
+                        #    analysis matrices are rebuilt as float32
+                        for item, embedding in zip(pending_items, item_matrix):
+                            item.embedding = embedding.astype(np.float16)
+                        docs_processed_count = len(pending_docs)
+                        chunks_processed_count = len(pending_chunks)
+                    except Exception as e:
+                        st.sidebar.error(f"Error generating embeddings: {e}")
+                        error_occurred = True
 
                 st.session_state.documents = updated_documents # Update session state with processed documents
 
                 # After processing all documents and their chunks, consolidate chunk embeddings
-                all_chunk_embeddings = []
-                all_chunk_labels = []
+                # First pass: size the matrix so rows can be written in place (no list-of-arrays copy)
+                n_embedded_chunks = 0
+                embedding_dim = None
+                for doc in st.session_state.documents:
+                    for chunk in doc.chunks:
+                        if chunk.embedding is not None:
+                            n_embedded_chunks += 1
+                            if embedding_dim is None: embedding_dim = chunk.embedding.shape[-1]
+
+                # C-contiguous float32 so the similarity/KNN GEMMs hit the BLAS fast path
+                all_chunk_embeddings = np.empty((n_embedded_chunks, embedding_dim or 0), dtype=np.float32)
+                all_chunk_labels = [None] * n_embedded_chunks # Preallocated and written by row, like the matrix
                 chunk_label_lookup_dict = {} # For debugging and easier lookup
-
+                # Row-aligned per-chunk columns (structure of arrays) alongside the embedding matrix
+                all_chunk_doc_idx = np.empty(n_embedded_chunks, dtype=np.int32)
+                all_chunk_source_titles = [None] * n_embedded_chunks
+                doc_has_embed = {} # Embedding-present flags, read O(1) by the document list expander
+                doc_chunk_embed_counts = {}
+
+                # Second pass: fill rows, labels and lookup entries
+                row = 0
                 for doc_idx, doc in enumerate(st.session_state.documents):
-                    if hasattr(doc, 'chunks') and doc.chunks:
-                        for chunk_idx, chunk in enumerate(doc.chunks):
-                            if chunk.embedding is not None:
-                                all_chunk_embeddings.append(chunk.embedding)
-                                label = f"{doc.title}_Chunk{chunk_idx+1}"
-                                all_chunk_labels.append(label)
-                                # Store index mapping: original doc_idx, chunk_idx to its position in the flat list
-                                chunk_label_lookup_dict[label] = {'doc_index': doc_idx, 'chunk_index': chunk_idx, 'flat_list_index': len(all_chunk_embeddings)-1}
-
-
-                if all_chunk_embeddings:
-                    st.session_state.all_chunk_embeddings_matrix = np.array(all_chunk_embeddings)
+                    doc_has_embed[doc.id] = doc.embedding is not None
+                    doc_chunk_embed_counts[doc.id] = 0
+                    for chunk_idx, chunk in enumerate(doc.chunks):
+                        if chunk.embedding is not None:
+                            doc_chunk_embed_counts[doc.id] += 1
+                            all_chunk_embeddings[row] = chunk.embedding
+                            label = f"{doc.title}_Chunk{chunk_idx+1}"
+                            all_chunk_labels[row] = label
+                            # Store index mapping: original doc_idx, chunk_idx to its position in the flat list (plus the source title)
+                            chunk_label_lookup_dict[label] = {'doc_index': doc_idx, 'chunk_index': chunk_idx, 'flat_list_index': row, 'doc_title': doc.title}
+                            chunk.corpus_index = row # Same row as 'flat_list_index'
+                            all_chunk_doc_idx[row] = doc_idx
+                            all_chunk_source_titles[row] = doc.title
+                            row += 1
+                        else:
+                            chunk.corpus_index = None
+
+
+                if n_embedded_chunks:
+                    # The raw matrix only feeds plotting and row gathers, so it is kept at the float16 precision of the
+                    # per-chunk copies (lossless, half the float32 size); every GEMM path works on the float32 normalised copy
+                    st.session_state.all_chunk_embeddings_matrix = all_chunk_embeddings.astype(np.float16)
+                    st.session_state.chunk_matrix_key = hashlib.blake2b(all_chunk_embeddings.tobytes(), digest_size=16).hexdigest()
+                    # Normalise once so every KNN query is a single GEMV against it; served from a shared memory map
+                    st.session_state.all_chunk_embeddings_matrix_norm = share_matrix_on_disk(
+                        analysis_service.normalize_rows(all_chunk_embeddings), 'chunk_embeds_norm', st.session_state.chunk_matrix_key
+                    )
+                    st.session_state.all_chunk_embeddings_matrix_i8 = analysis_service.quantize_rows_int8(st.session_state.all_chunk_embeddings_matrix_norm)
                     st.session_state.all_chunk_labels = all_chunk_labels
                     st.session_state.chunk_label_lookup_dict = chunk_label_lookup_dict # Save for potential use
-
-                    # --- START DEBUG EMBEDDING ---
-                    # st.sidebar.write("--- DEBUG EMBEDDING ---")
-                    # matrix_shape_debug = st.session_state.all_chunk_embeddings_matrix.shape if st.session_state.all_chunk_embeddings_matrix is not None else "None"
-                    # labels_len_debug = len(st.session_state.all_chunk_labels) if st.session_state.all_chunk_labels is not None else "None"
-                    # lookup_len_debug = len(st.session_state.chunk_label_lookup_dict) if st.session_state.chunk_label_lookup_dict is not None else "None"
-                    # st.sidebar.write(f"Post-consolidation: Matrix shape: {matrix_shape_debug}, Labels len: {labels_len_debug}, Lookup len: {lookup_len_debug}")
-                    # if st.session_state.all_chunk_labels and isinstance(st.session_state.all_chunk_labels, list) and len(st.session_state.all_chunk_labels) > 0:
-                    #    st.sidebar.write(f"First label: {st.session_state.all_chunk_labels[0]}")
-                    # if st.session_state.chunk_label_lookup_dict and isinstance(st.session_state.chunk_label_lookup_dict, dict) and len(st.session_state.chunk_label_lookup_dict) > 0:
-                    #    st.sidebar.write(f"First lookup entry example (first key): {list(st.session_state.chunk_label_lookup_dict.keys())[0]}")
-                    # st.sidebar.write("--- END DEBUG ---")
-                    # --- END DEBUG EMBEDDING ---
+                    st.session_state.all_chunk_doc_idx = all_chunk_doc_idx
+                    st.session_state.all_chunk_source_titles = all_chunk_source_titles
+                    # One SGEMM now turns every later centroid query into table lookups
+                    st.session_state.chunk_sim_matrix = None
+                    get_chunk_sim_matrix()
                 else:
                     st.session_state.all_chunk_embeddings_matrix = None # Ensure it's reset if no chunks
+                    st.session_state.all_chunk_embeddings_matrix_norm = None
+                    st.session_state.all_chunk_embeddings_matrix_i8 = None
+                    st.session_state.chunk_sim_matrix = None
+                    st.session_state.chunk_matrix_key = None
                     st.session_state.all_chunk_labels = []
                     st.session_state.chunk_label_lookup_dict = {}
+                    st.session_state.all_chunk_doc_idx = None
+                    st.session_state.all_chunk_source_titles = []
+
 
+                # Document-level matrix for selection analysis, built once here instead of per selection event
+                st.session_state.doc_matrix_key = None # Embeddings changed: force a rebuild
+                get_doc_corpus([doc for doc in st.session_state.documents if doc.embedding is not None])
 
+                st.session_state.doc_has_embed = doc_has_embed
+                try:
+                    st.session_state.doc_color_map = build_color_map(tuple(doc.title for doc in st.session_state.documents))
+                except Exception as e:
+                    st.sidebar.error(f"Error generating color map for documents: {e}")
+                    st.session_state.doc_color_map = {}
+                st.session_state.doc_chunk_embed_counts = doc_chunk_embed_counts
                 st.session_state.embeddings_generated = True
+                bump_docs_version()
                 msg = f"Embeddings generated for {docs_processed_count} documents and {chunks_processed_count} chunks."
                 if error_occurred:
                     st.sidebar.warning(msg + " (with errors)")
@@ -318,13 +743,12 @@ if st.sidebar.button("Generate Embeddings", disabled=not embedding_service):
                 st.session_state.current_coords_2d = None
                 st.session_state.current_labels = []
                 st.session_state.coords_3d = None
-                st.rerun()
+                # No st.rerun(): the sidebar handlers run before the main area, which picks up the new state in this pass
 
         except Exception as e:
             st.sidebar.error(f"An unexpected error occurred during embedding generation: {e}")
             # Potentially reset parts of the state if a major failure occurs
             reset_derived_data(clear_docs=False) # Reset relevant parts
-            st.rerun() # Rerun to reflect state changes
     elif not embedding_service:
         st.sidebar.error("Embedding Service not available.")
     else:
@@ -343,7 +767,7 @@ can_analyze = False # Flag to check if enough data for analysis exists
 
 if st.session_state.get('embeddings_generated'):
     if analysis_level == 'Documents':
-        items_available_for_level = sum(1 for doc in st.session_state.documents if doc.embedding is not None)
+        items_available_for_level = len(get_embedded_docs()[0])
         if items_available_for_level >= MIN_ITEMS_FOR_PLOT:
             embeddings_exist = True # Enough docs with embeddings for plotting
         if items_available_for_level >= 1: # Need at least 1 for analysis
@@ -357,259 +781,219 @@ if st.session_state.get('embeddings_generated'):
              can_analyze = True
 
 # --- Visualization Section ---
-st.header("Embedding Space Visualization")
-if not embeddings_exist:
-    if analysis_level == 'Documents':
-        st.warning(f"Generate embeddings. Document plotting requires >= {MIN_ITEMS_FOR_PLOT} docs with embeddings.")
-    else: # Chunks
-        st.warning("Generate embeddings for chunks.")
-elif not analysis_service or not visualization_service:
-    st.error("Analysis or Visualization Service not available.")
-else:
-    col1, col2 = st.columns(2)
-    plot_title_suffix = analysis_level
-
-    # --- Get Embeddings/Labels for Plotting ---
-    embeddings_to_plot = None
-    labels_to_plot = []
-    source_doc_titles_for_plot = None
-    doc_color_map = None # Initialize color map
-    color_categories_for_plot = None # Initialize color categories for plot
-
-    if analysis_level == 'Documents':
-        # Only consider docs with embeddings for plotting
-        docs_with_embeddings = [doc for doc in st.session_state.documents if doc.embedding is not None]
-        if len(docs_with_embeddings) >= MIN_ITEMS_FOR_PLOT:
-             embeddings_to_plot = np.array([doc.embedding for doc in docs_with_embeddings])
-             labels_to_plot = [doc.title for doc in docs_with_embeddings]
-
-             # --- Generate color map for documents ---
-             try:
-                unique_titles = sorted(list(set(labels_to_plot)))
-                color_sequence = px.colors.qualitative.Plotly
-                doc_color_map = {title: color_sequence[i % len(color_sequence)] for i, title in enumerate(unique_titles)}
-                st.session_state['doc_color_map'] = doc_color_map # Store for table styling
-                # For plot: use titles as color category, map provides actual colors
-                color_categories_for_plot = labels_to_plot
-             except Exception as e:
-                  st.error(f"Error generating color map for documents: {e}")
-                  color_categories_for_plot = None
-                  doc_color_map = None
-                  st.session_state.pop('doc_color_map', None)
-
-        # else: plotting buttons will be disabled
-    elif analysis_level == 'Chunks':
-        embeddings_to_plot = st.session_state.get('all_chunk_embeddings_matrix')
-        labels_to_plot = st.session_state.get('all_chunk_labels', [])
-        if labels_to_plot:
-            # Derive color data from labels stored in session state
-            try:
-                lookup = st.session_state.get('chunk_label_lookup_dict', {})
-                labels_to_plot = st.session_state.get('all_chunk_labels', [])
-                source_doc_titles_full = []
-                color_categories_for_plot = None
-                doc_color_map = {} # Initialize as empty dict
-
-                if lookup and labels_to_plot:
-                     # Extract the stored doc.title (element 1 of the tuple) from the lookup
-                     try:
-                          # Ensure label exists in lookup before accessing
-                          source_doc_titles_full = [lookup[label][1] for label in labels_to_plot if label in lookup]
-                     except (KeyError, IndexError, TypeError) as e:
-                          st.error(f"Error accessing titles from lookup: {e}")
-                          source_doc_titles_full = [] # Reset on error
-
-                # Proceed only if we successfully extracted titles
-                if source_doc_titles_full:
+@st.fragment
+def visualization_section():
+    """Plots and plot-selection analysis; runs as a fragment so point selections only rerun this section."""
+    st.header("Embedding Space Visualization")
+    if not embeddings_exist:
+        if analysis_level == 'Documents':
+            st.warning(f"Generate embeddings. Document plotting requires >= {MIN_ITEMS_FOR_PLOT} docs with embeddings.")
+        else: # Chunks
+            st.warning("Generate embeddings for chunks.")
+    elif not analysis_service or not visualization_service:
+        st.error("Analysis or Visualization Service not available.")
+    else:
+        col1, col2 = st.columns(2)
+        plot_title_suffix = analysis_level
+
+        # --- Get Embeddings/Labels for Plotting ---
+        embeddings_to_plot = None
+        plot_matrix_key = None # Digest of embeddings_to_plot, keys the cached UMAP projections
+        labels_to_plot = []
+        source_doc_titles_for_plot = None
+        color_categories_for_plot = None # Initialize color categories for plot
+
+        # Title -> color for every loaded document, built once per embedding run (shared by both levels and the table)
+        doc_color_map = st.session_state.get('doc_color_map', {})
+
+        if analysis_level == 'Documents':
+            # Only consider docs with embeddings for plotting
+            docs_with_embeddings, _ = get_embedded_docs()
+            if len(docs_with_embeddings) >= MIN_ITEMS_FOR_PLOT:
+                 embeddings_to_plot, labels_to_plot = get_doc_corpus(docs_with_embeddings)
+                 plot_matrix_key = st.session_state.doc_matrix_digest
+                 # For plot: use titles as color category, map provides actual colors
+                 color_categories_for_plot = labels_to_plot
+
+            # else: plotting buttons will be disabled
+        elif analysis_level == 'Chunks':
+            embeddings_to_plot = st.session_state.get('all_chunk_embeddings_matrix')
+            plot_matrix_key = st.session_state.get('chunk_matrix_key')
+            labels_to_plot = st.session_state.get('all_chunk_labels', [])
+            if labels_to_plot:
+                # Built row by row at embedding time, so no per-label lookups on each rerun
+                source_doc_titles_full = st.session_state.get('all_chunk_source_titles', [])
+                if len(source_doc_titles_full) == len(labels_to_plot) and doc_color_map:
                     color_categories_for_plot = source_doc_titles_full
-                    try:
-                        # --- Generate color map ---
-                        unique_titles = sorted(list(set(source_doc_titles_full)))
-                        color_sequence = px.colors.qualitative.Plotly
-                        doc_color_map = {title: color_sequence[i % len(color_sequence)] for i, title in enumerate(unique_titles)}
-                        st.session_state['doc_color_map'] = doc_color_map # Store in session state
-                    except Exception as map_e:
-                         st.error(f"Error generating color map: {map_e}")
-                         doc_color_map = {} # Reset to empty on error
-                         color_categories_for_plot = None
-                         st.session_state.pop('doc_color_map', None)
                 else:
-                     # Failed to get titles, ensure map is empty and state is clear
-                     st.warning("Could not derive source document titles for chunk coloring.")
-                     doc_color_map = {}
-                     color_categories_for_plot = None
-                     st.session_state.pop('doc_color_map', None)
+                    # Stale relative to the labels; plot without coloring
+                    st.warning("Could not derive source document titles for chunk coloring.")
 
-            except Exception as e:
-                 # Catch any other unexpected errors in this block
-                 st.error(f"Unexpected error during color setup: {e}")
-                 doc_color_map = {}
-                 color_categories_for_plot = None
-                 st.session_state.pop('doc_color_map', None)
-
-    # --- Plotting Buttons ---
-    # Ensure we have data before enabling buttons
-    can_plot_now = embeddings_to_plot is not None and embeddings_to_plot.shape[0] >= (MIN_ITEMS_FOR_PLOT if analysis_level == 'Documents' else 1)
-
-    with col1:
-        if st.button("Show 2D Plot", disabled=not can_plot_now):
-            st.session_state.scatter_fig_2d = None
-            st.session_state.current_coords_2d = None
-            st.session_state.current_labels = []
-
-            if analysis_level == 'Documents' and items_available_for_level < MIN_ITEMS_FOR_PLOT:
-                st.error(f"Plotting requires >= {MIN_ITEMS_FOR_PLOT} documents with embeddings.")
-            else: # Only proceed if enough items
-                try:
-                    with st.spinner(f"Reducing {analysis_level.lower()} dimensions to 2D..."):
-                        # Ensure embeddings_to_plot is valid before passing
-                        # The check in AnalysisService is now primary, but this is a safety layer
-                        if embeddings_to_plot is not None and embeddings_to_plot.shape[0] >= (1 if analysis_level == 'Chunks' else MIN_ITEMS_FOR_PLOT):
-                             coords_2d = analysis_service.reduce_dimensions(embeddings_to_plot, n_components=2)
-                             # Check if reduce_dimensions returned None (due to error or insufficient samples)
-                             if coords_2d is None:
-                                  st.error("Failed to generate 2D coordinates (check logs for details).")
-                                  # Avoid further plotting logic if coords are None
-                             else:
-                                 st.session_state.current_coords_2d = coords_2d
-                                 st.session_state.current_labels = labels_to_plot
-                                 # Use the generated color list if plotting chunks
-                                 # Pass titles for color categories, and map for colors
-                                 color_categories = color_categories_for_plot if analysis_level == 'Chunks' else None
-                                 color_map_arg = doc_color_map if analysis_level == 'Chunks' else None
-
-                                 fig_2d = visualization_service.plot_scatter_2d(
-                                     coords=coords_2d, labels=labels_to_plot,
-                                     title=f"2D UMAP Projection of {plot_title_suffix}", 
-                                     color_categories=color_categories, # Pass titles for legend
-                                     color_discrete_map=color_map_arg # Pass title->color map
-                                 )
-                                 st.session_state.scatter_fig_2d = fig_2d
-                        else:
-                             st.warning("Insufficient data provided for dimensionality reduction.")
+        # --- Plotting Buttons ---
+        # Ensure we have data before enabling buttons
+        can_plot_now = embeddings_to_plot is not None and embeddings_to_plot.shape[0] >= (MIN_ITEMS_FOR_PLOT if analysis_level == 'Documents' else 1)
 
-                except Exception as e:
-                     st.error(f"Error generating 2D plot: {e}")
+        with col1:
+            if st.button("Show 2D Plot", disabled=not can_plot_now):
+                st.session_state.scatter_fig_2d = None
+                st.session_state.current_coords_2d = None
+                st.session_state.current_labels = []
 
-    with col2:
-        if st.button("Show 3D Plot", disabled=not can_plot_now):
-            st.session_state.scatter_fig_2d = None # Clear 2D plot state
-            st.session_state.current_coords_2d = None
-            st.session_state.current_labels = []
+                if analysis_level == 'Documents' and items_available_for_level < MIN_ITEMS_FOR_PLOT:
+                    st.error(f"Plotting requires >= {MIN_ITEMS_FOR_PLOT} documents with embeddings.")
+                else: # Only proceed if enough items
+                    try:
+                        with st.spinner(f"Reducing {analysis_level.lower()} dimensions to 2D..."):
+                            # Ensure embeddings_to_plot is valid before passing
+                            # The check in AnalysisService is now primary, but this is a safety layer
+                            if embeddings_to_plot is not None and embeddings_to_plot.shape[0] >= (1 if analysis_level == 'Chunks' else MIN_ITEMS_FOR_PLOT):
+                                 coords_2d = reduce_dimensions_cached(plot_matrix_key, embeddings_to_plot, n_components=2)
+                                 # Check if reduce_dimensions returned None (due to error or insufficient samples)
+                                 if coords_2d is None:
+                                      st.error("Failed to generate 2D coordinates (check logs for details).")
+                                      # Avoid further plotting logic if coords are None
+                                 else:
+                                     st.session_state.current_coords_2d = coords_2d
+                                     st.session_state.current_labels = labels_to_plot
+                                     # Use the generated color list if plotting chunks
+                                     # Pass titles for color categories, and map for colors
+                                     color_categories = color_categories_for_plot if analysis_level == 'Chunks' else None
+                                     color_map_arg = doc_color_map if analysis_level == 'Chunks' else None
+
+                                     fig_2d = visualization_service.plot_scatter_2d(
+                                         coords=coords_2d, labels=labels_to_plot,
+                                         title=f"2D UMAP Projection of {plot_title_suffix}", 
+                                         color_categories=color_categories, # Pass titles for legend
+                                         color_discrete_map=color_map_arg # Pass title->color map
+                                     )
+                                     st.session_state.scatter_fig_2d = fig_2d
+                            else:
+                                 st.warning("Insufficient data provided for dimensionality reduction.")
 
-            if analysis_level == 'Documents' and items_available_for_level < MIN_ITEMS_FOR_PLOT:
-                st.error(f"Plotting requires >= {MIN_ITEMS_FOR_PLOT} documents with embeddings.")
-            else: # Only proceed if enough items
-                try:
-                    with st.spinner(f"Reducing {analysis_level.lower()} dimensions to 3D..."):
-                        # Ensure embeddings_to_plot is valid before passing
-                        if embeddings_to_plot is not None and embeddings_to_plot.shape[0] >= (1 if analysis_level == 'Chunks' else MIN_ITEMS_FOR_PLOT):
-                            coords_3d = analysis_service.reduce_dimensions(embeddings_to_plot, n_components=3)
-                            # Check if reduce_dimensions returned None
-                            if coords_3d is None:
-                                st.error("Failed to generate 3D coordinates (check logs for details).")
+                    except Exception as e:
+                         st.error(f"Error generating 2D plot: {e}")
+
+        with col2:
+            if st.button("Show 3D Plot", disabled=not can_plot_now):
+                st.session_state.scatter_fig_2d = None # Clear 2D plot state
+                st.session_state.current_coords_2d = None
+                st.session_state.current_labels = []
+
+                if analysis_level == 'Documents' and items_available_for_level < MIN_ITEMS_FOR_PLOT:
+                    st.error(f"Plotting requires >= {MIN_ITEMS_FOR_PLOT} documents with embeddings.")
+                else: # Only proceed if enough items
+                    try:
+                        with st.spinner(f"Reducing {analysis_level.lower()} dimensions to 3D..."):
+                            # Ensure embeddings_to_plot is valid before passing
+                            if embeddings_to_plot is not None and embeddings_to_plot.shape[0] >= (1 if analysis_level == 'Chunks' else MIN_ITEMS_FOR_PLOT):
+                                coords_3d = reduce_dimensions_cached(plot_matrix_key, embeddings_to_plot, n_components=3)
+                                st.session_state.coords_3d = coords_3d
+                                # Check if reduce_dimensions returned None
+                                if coords_3d is None:
+                                    st.error("Failed to generate 3D coordinates (check logs for details).")
+                                else:
+                                    # Use the generated color list if available (handles both levels)
+                                    color_arg = color_categories_for_plot if analysis_level == 'Chunks' else None
+                                    fig_3d = visualization_service.plot_scatter_3d(
+                                       coords=coords_3d, labels=labels_to_plot,
+                                       title=f"3D UMAP Projection of {plot_title_suffix}",
+                                       color_data=color_arg # Pass color data
+                                    )
+                                    st.plotly_chart(fig_3d, use_container_width=True)
                             else:
-                                # Use the generated color list if available (handles both levels)
-                                color_arg = color_categories_for_plot if analysis_level == 'Chunks' else None
-                                fig_3d = visualization_service.plot_scatter_3d(
-                                   coords=coords_3d, labels=labels_to_plot,
-                                   title=f"3D UMAP Projection of {plot_title_suffix}",
-                                   color_data=color_arg # Pass color data
-                                )
-                                st.plotly_chart(fig_3d, use_container_width=True)
-                        else:
-                            st.warning("Insufficient data provided for dimensionality reduction.")
-                except Exception as e:
-                     st.error(f"Error generating 3D plot: {e}")
-
-    # --- Display 2D Plot and Handle Selection (Semantic Center) ---
-    if st.session_state.get('scatter_fig_2d') is not None:
-         event_data = st.plotly_chart(
-             st.session_state.scatter_fig_2d, use_container_width=True,
-             on_select="rerun", key="umap_scatter_2d"
-         )
-
-         selection = None
-         # Check for selection event data using the chart key
-         if event_data and event_data.get("selection") and event_data["selection"].get("point_indices"):
-             selected_indices = event_data["selection"]["point_indices"]
-             if selected_indices:
-                 selection = {'indices': selected_indices}
-                 print(f"DEBUG: Plot selection detected: Indices {selected_indices}")
-
-         if selection and len(selection['indices']) == 3:
-             st.subheader("Triangle Analysis (Plot Selection)")
-             selected_indices_from_plot = selection['indices']
-             current_plot_labels = st.session_state.get('current_labels', []) # Labels shown on the plot
-
-             if current_plot_labels and all(idx < len(current_plot_labels) for idx in selected_indices_from_plot):
-                 selected_labels_display = [current_plot_labels[i] for i in selected_indices_from_plot]
-                 st.write("**Selected Vertices:**")
-                 for i, label in enumerate(selected_labels_display):
-                     st.write(f"- {label} (Plot Index: {selected_indices_from_plot[i]})")
-
-                 try:
-                     # --- Get High-Dim Data for Analysis ---
-                     selected_high_dim_embeddings = [] # Use list for flexibility
-                     high_dim_corpus_matrix = None
-                     high_dim_corpus_labels = []
-
-                     if analysis_level == 'Documents':
-                         docs_map = {doc.title: doc for doc in st.session_state.documents if doc.embedding is not None}
-                         selected_docs = [docs_map.get(lbl) for lbl in selected_labels_display]
-                         if None in selected_docs or any(doc.embedding is None for doc in selected_docs):
-                             st.error("Could not map all selected plot labels back to documents with embeddings.")
-                         else:
-                             selected_high_dim_embeddings = [doc.embedding for doc in selected_docs]
-                             all_docs_with_embeddings = list(docs_map.values())
-                             high_dim_corpus_matrix = np.array([doc.embedding for doc in all_docs_with_embeddings])
-                             high_dim_corpus_labels = [doc.title for doc in all_docs_with_embeddings]
-
-                     elif analysis_level == 'Chunks':
-                         high_dim_corpus_matrix = st.session_state.get('all_chunk_embeddings_matrix')
-                         high_dim_corpus_labels = st.session_state.get('all_chunk_labels', [])
-                         # Assumes the plot indices directly correspond to the matrix rows
-                         if high_dim_corpus_matrix is not None and all(idx < high_dim_corpus_matrix.shape[0] for idx in selected_indices_from_plot):
-                             selected_high_dim_embeddings = high_dim_corpus_matrix[selected_indices_from_plot].tolist() # Ensure list
-                         else:
-                             st.error("Mismatch between plot indices and chunk embedding matrix.")
-                             selected_high_dim_embeddings = [] # Mark as invalid
-
-                     # --- Proceed if embeddings found ---
-                     if len(selected_high_dim_embeddings) == 3 and high_dim_corpus_matrix is not None and high_dim_corpus_labels:
-                         try:
-                             mean_high_dim_emb = np.mean(np.array(selected_high_dim_embeddings), axis=0)
-                             nn_indices, nn_scores = analysis_service.find_k_nearest(
-                                 mean_high_dim_emb, high_dim_corpus_matrix, k=1
-                             )
+                                st.warning("Insufficient data provided for dimensionality reduction.")
+                    except Exception as e:
+                         st.error(f"Error generating 3D plot: {e}")
+
+        # --- Display 2D Plot and Handle Selection (Semantic Center) ---
+        if st.session_state.get('scatter_fig_2d') is not None:
+             event_data = st.plotly_chart(
+                 st.session_state.scatter_fig_2d, use_container_width=True,
+                 on_select="rerun", key="umap_scatter_2d"
+             )
+
+             selection = None
+             # Check for selection event data using the chart key
+             if event_data and event_data.get("selection") and event_data["selection"].get("point_indices"):
+                 selected_indices = event_data["selection"]["point_indices"]
+                 if selected_indices:
+                     selection = {'indices': selected_indices}
+
+             if selection and len(selection['indices']) == 3:
+                 st.subheader("Triangle Analysis (Plot Selection)")
+                 selected_indices_from_plot = selection['indices']
+                 current_plot_labels = st.session_state.get('current_labels', []) # Labels shown on the plot
+
+                 if current_plot_labels and all(idx < len(current_plot_labels) for idx in selected_indices_from_plot):
+                     selected_labels_display = [current_plot_labels[i] for i in selected_indices_from_plot]
+                     st.write("**Selected Vertices:**")
+                     for i, label in enumerate(selected_labels_display):
+                         st.write(f"- {label} (Plot Index: {selected_indices_from_plot[i]})")
 
-                             if nn_indices is not None and len(nn_indices) > 0:
-                                 nearest_neighbor_index = nn_indices[0]
-                                 # Check index bounds for safety
-                                 if nearest_neighbor_index < len(high_dim_corpus_labels):
-                                     nearest_neighbor_label = high_dim_corpus_labels[nearest_neighbor_index]
-                                     nearest_neighbor_score = nn_scores[0]
-                                     st.write(f"**Semantic Center:** Closest item is **{nearest_neighbor_label}**")
-                                     st.write(f"(Similarity Score: {nearest_neighbor_score:.4f})")
-                                 else:
-                                     st.error("Nearest neighbor index out of bounds!")
+                     try:
+                         # --- Get High-Dim Data for Analysis ---
+                         selected_rows = [] # Rows of source_matrix; stays empty if the selection cannot be mapped
+                         source_matrix, corpus_digest = None, None
+                         high_dim_corpus_matrix = None
+                         high_dim_corpus_labels = []
+
+                         if analysis_level == 'Documents':
+                             doc_title_to_index = st.session_state.doc_title_to_index
+                             doc_rows = [doc_title_to_index.get(lbl) for lbl in selected_labels_display]
+                             if None in doc_rows or st.session_state.doc_matrix is None:
+                                 st.error("Could not map all selected plot labels back to documents with embeddings.")
                              else:
-                                 st.warning("Could not determine the nearest item to the semantic center.")
-                         except Exception as analysis_err:
-                              st.error(f"Error calculating semantic center: {analysis_err}")
-                     else:
-                         # Error message already displayed or handled above
-                         if not selected_high_dim_embeddings:
-                              st.warning("Could not retrieve embeddings for selected points.")
-                         elif high_dim_corpus_matrix is None or not high_dim_corpus_labels:
-                              st.warning("Corpus embeddings unavailable for analysis.")
-
-                 except Exception as e:
-                     st.error(f"Error during plot selection analysis setup: {e}")
-             else:
-                 st.warning("Selection indices out of bounds or plot labels mismatch.")
-         elif selection:
-             st.info(f"Select exactly 3 points for triangle analysis (selected {len(selection['indices'])}).")
+                                 high_dim_corpus_matrix = st.session_state.doc_matrix_norm
+                                 high_dim_corpus_labels = st.session_state.doc_titles
+                                 source_matrix, corpus_digest = st.session_state.doc_matrix, st.session_state.doc_matrix_digest
+                                 selected_rows = doc_rows
+
+                         elif analysis_level == 'Chunks':
+                             chunk_matrix = st.session_state.get('all_chunk_embeddings_matrix')
+                             high_dim_corpus_matrix = st.session_state.get('all_chunk_embeddings_matrix_norm')
+                             high_dim_corpus_labels = st.session_state.get('all_chunk_labels', [])
+                             # Assumes the plot indices directly correspond to the matrix rows
+                             if chunk_matrix is not None and high_dim_corpus_matrix is not None and all(idx < chunk_matrix.shape[0] for idx in selected_indices_from_plot):
+                                 source_matrix, corpus_digest = chunk_matrix, st.session_state.get('chunk_matrix_key')
+                                 selected_rows = list(selected_indices_from_plot)
+                             else:
+                                 st.error("Mismatch between plot indices and chunk embedding matrix.")
+                                 selected_rows = [] # Mark as invalid
+
+                         # --- Proceed if embeddings found ---
+                         if len(selected_rows) == 3 and high_dim_corpus_matrix is not None and high_dim_corpus_labels:
+                             try:
+                                 nearest_neighbor_index, nearest_neighbor_score = centroid_nearest_cached(
+                                     tuple(sorted(selected_rows)), corpus_digest, source_matrix, high_dim_corpus_matrix
+                                 )
+
+                                 if nearest_neighbor_index is not None:
+                                     # Check index bounds for safety
+                                     if nearest_neighbor_index < len(high_dim_corpus_labels):
+                                         nearest_neighbor_label = high_dim_corpus_labels[nearest_neighbor_index]
+                                         st.write(f"**Semantic Center:** Closest item is **{nearest_neighbor_label}**")
+                                         st.write(f"(Similarity Score: {nearest_neighbor_score:.4f})")
+                                     else:
+                                         st.error("Nearest neighbor index out of bounds!")
+                                 else:
+                                     st.warning("Could not determine the nearest item to the semantic center.")
+                             except Exception as analysis_err:
+                                  st.error(f"Error calculating semantic center: {analysis_err}")
+                         else:
+                             # Error message already displayed or handled above
+                             if not selected_rows:
+                                  st.warning("Could not retrieve embeddings for selected points.")
+                             elif high_dim_corpus_matrix is None or not high_dim_corpus_labels:
+                                  st.warning("Corpus embeddings unavailable for analysis.")
+
+                     except Exception as e:
+                         st.error(f"Error during plot selection analysis setup: {e}")
+                 else:
+                     st.warning("Selection indices out of bounds or plot labels mismatch.")
+             elif selection:
+                 st.info(f"Select exactly 3 points for triangle analysis (selected {len(selection['indices'])}).")
+
+visualization_section()
 
 
 # --- Document/Chunk Structure Table & Multiselect Analysis ---
@@ -623,60 +1007,25 @@ with st.expander("View Document/Chunk Structure & Select Chunks for Analysis"):
 
         if not chunk_labels_exist:
              # Check if chunking attribute exists but maybe embedding hasn't run yet
-             docs_have_chunks_attr = any(hasattr(doc, 'chunks') for doc in st.session_state.documents)
+             docs_have_chunks_attr = any(doc.chunks for doc in st.session_state.documents)
              if docs_have_chunks_attr:
                  st.info("Chunking run, but embeddings not generated yet (or no embeddings found). Click 'Generate Embeddings'.")
              else:
                   st.info("Run 'Chunk Loaded Documents' first.")
         else: # Chunk labels exist in session state - proceed to display table & multiselect
-            # --- Build Table Data --- (Only if chunk labels exist)
-            table_data = []
-            max_chunks = 0
-            doc_titles_in_table = [] # Store original doc titles for styling
-            # Build based on actual docs and their chunks attribute
-            for doc in st.session_state.documents:
-                 if hasattr(doc, 'chunks') and doc.chunks:
-                      max_chunks = max(max_chunks, len(doc.chunks))
-
-            if max_chunks > 0: # Ensure we actually have chunks to build the table rows
-                for doc in st.session_state.documents:
-                    # Store the original title for styling lookup later
-                    doc_titles_in_table.append(doc.title)
-                    row_data = {'Document': doc.title} # Use original title here
-                    if hasattr(doc, 'chunks') and doc.chunks:
-                         for i in range(max_chunks):
-                             col_name = f"Chunk {i+1}"
-                             # Check chunk exists at index i before accessing attribute
-                             row_data[col_name] = doc.chunks[i].context_label if i < len(doc.chunks) and doc.chunks[i] else ""
-                    else: # Handle docs without chunks attribute or empty chunks list
-                         for i in range(max_chunks): row_data[f"Chunk {i+1}"] = "-" # Placeholder
-                    table_data.append(row_data)
-
             # --- Display Table with Styling ---
-            if table_data:
+            # The expander body runs even when collapsed; the styled table is only built and sent once opted in
+            if st.checkbox("Show chunk overview table", key='show_structure', value=False):
                 try:
-                    df = pd.DataFrame(table_data) # Keep 'Document' as a column
-
-                    # --- Styling Function ---
-                    # Retrieve color map, provide empty dict fallback
-                    doc_color_map_for_style = st.session_state.get('doc_color_map', {})
-
-                    def get_color_style(doc_title):
-                        color = doc_color_map_for_style.get(doc_title, None) # Get color from map
-                        return f'background-color: {color}' if color else ''
-
-                    # Apply styling to the 'Document' column using Styler.map
-                    st.write("Chunk Overview (Context Labels shown):")
-                    st.dataframe(df.style.map(get_color_style, subset=['Document']))
-
+                    structure_table = get_structure_table()
+                    if structure_table is not None:
+                        st.write("Chunk Overview (Context Labels shown):")
+                        st.dataframe(structure_table)
+                    else:
+                        # This case means chunk_labels exist, but no docs actually had > 0 chunks
+                        st.info("Chunking process resulted in 0 chunks across all documents (although labels might exist from a previous run). Re-chunk if needed.")
                 except Exception as e:
                      st.error(f"Error creating or styling structure table: {e}")
-            elif max_chunks == 0:
-                # This case means chunk_labels exist, but no docs actually had > 0 chunks
-                st.info("Chunking process resulted in 0 chunks across all documents (although labels might exist from a previous run). Re-chunk if needed.")
-            else:
-                 # This case might indicate an issue if max_chunks > 0 but table_data is empty
-                 st.warning("Chunk labels found, but failed to build table data from document chunks.")
 
 
             # --- Multiselect Logic (Only if chunk_labels_exist) ---
@@ -698,42 +1047,30 @@ with st.expander("View Document/Chunk Structure & Select Chunks for Analysis"):
                      for label in selected_chunk_labels: st.write(f"- {label}")
                      # --- Analysis Logic --- (Assumes previous corrections were okay)
                      try: # <-- Add try/except around analysis
-                          selected_chunks = [lookup.get(label) for label in selected_chunk_labels]
+                          selected_entries = [lookup.get(label) for label in selected_chunk_labels]
+                          corpus_labels = st.session_state.get('all_chunk_labels', [])
 
-                          if None in selected_chunks: # <-- Level A
+                          if None in selected_entries: # <-- Level A
                                st.error("Could not find data for one or more selected chunk labels.")
-                          else: # <-- Level A (Matches 'if None in selected_chunks:')
-                              selected_embeddings = [chunk.embedding for chunk in selected_chunks]
-
-                              # Check if all embeddings are valid
-                              if all(emb is not None for emb in selected_embeddings): # <-- Level B
-                                  mean_high_dim_emb = np.mean(np.array(selected_embeddings), axis=0)
-                                  corpus_embeddings_array = st.session_state.get('all_chunk_embeddings_matrix')
-                                  corpus_labels = st.session_state.get('all_chunk_labels', [])
-
-                                  # Check 1: Corpus valid?
-                                  if corpus_embeddings_array is None or not corpus_labels: # <-- Level C
-                                     st.error("Chunk corpus unavailable for KNN search.")
-                                  # Check 2: Corpus usable for KNN?
-                                  elif corpus_embeddings_array.ndim == 2 and corpus_embeddings_array.shape[0] > 0: # <-- Level C
-                                     indices, scores = analysis_service.find_k_nearest(mean_high_dim_emb, corpus_embeddings_array, k=1)
-                                     if indices is not None and len(indices) > 0: # <-- Level D
-                                         nearest_neighbor_index = indices[0]
-                                         if nearest_neighbor_index < len(corpus_labels): # Bounds check
-                                              nearest_neighbor_label = corpus_labels[nearest_neighbor_index]
-                                              nearest_neighbor_score = scores[0]
-                                              st.write(f"**Semantic Center:** Closest item is **{nearest_neighbor_label}**")
-                                              st.write(f"(Similarity Score: {nearest_neighbor_score:.4f})")
-                                         else:
-                                             st.error("Nearest neighbor index out of bounds.")
-                                     else: # <-- Level D
-                                         st.warning("Could not determine the nearest item to the semantic center.")
-                                  # Else for Checks 1 & 2
-                                  else: # <-- Level C
-                                     st.error("Invalid corpus created for KNN search.")
-                              # Else for `if all(emb is not None...)`
-                              else: # <-- Level B
-                                 st.error("One or more selected chunks lack embeddings.")
+                          elif not corpus_labels or st.session_state.get('all_chunk_embeddings_matrix') is None: # <-- Level A
+                               st.error("Chunk corpus unavailable for KNN search.")
+                          else: # <-- Level A
+                              selected_rows = [entry['flat_list_index'] for entry in selected_entries]
+                              # Table lookup when the N x N matrix is cached, else one fused centroid scan (corpus too large)
+                              nearest_neighbor_index, nearest_neighbor_score = centroid_nearest_cached(
+                                  tuple(sorted(selected_rows)), st.session_state.get('chunk_matrix_key'),
+                                  st.session_state.all_chunk_embeddings_matrix, st.session_state.all_chunk_embeddings_matrix_norm,
+                                  get_chunk_sim_matrix()
+                              )
+
+                              if nearest_neighbor_index is None: # <-- Level C
+                                  st.warning("Could not determine the nearest item to the semantic center.")
+                              elif nearest_neighbor_index < len(corpus_labels): # Bounds check
+                                  nearest_neighbor_label = corpus_labels[nearest_neighbor_index]
+                                  st.write(f"**Semantic Center:** Closest item is **{nearest_neighbor_label}**")
+                                  st.write(f"(Similarity Score: {nearest_neighbor_score:.4f})")
+                              else:
+                                  st.error("Nearest neighbor index out of bounds.")
                      except Exception as e: # Catch analysis errors
                            st.error(f"An error occurred during table selection analysis: {e}")
                 else: # Belongs to if len == 3
@@ -746,9 +1083,8 @@ item_map = {}
 current_level = st.session_state.get('analysis_level', 'Documents')
 
 if current_level == 'Documents':
-    docs_with_embed = [doc for doc in st.session_state.documents if doc.embedding is not None]
-    item_options = [doc.title for doc in docs_with_embed]
-    item_map = {doc.title: doc for doc in docs_with_embed}
+    docs_with_embed, item_map = get_embedded_docs()
+    item_options = list(item_map)
 elif current_level == 'Chunks':
     item_options = st.session_state.get('all_chunk_labels', [])
     item_map = st.session_state.get('chunk_label_lookup_dict', {})
@@ -757,52 +1093,57 @@ MIN_ITEMS_FOR_SIMPLEX = 3
 if len(item_options) < MIN_ITEMS_FOR_SIMPLEX:
     st.info(f"Requires at least {MIN_ITEMS_FOR_SIMPLEX} {current_level.lower()} with embeddings for manual analysis.")
 else:
-    item1_label = st.selectbox(f"Select Vertex 1 ({current_level[:-1]}):", options=item_options, key="manual_v1", index=0)
-    item2_label = st.selectbox(f"Select Vertex 2 ({current_level[:-1]}):", options=item_options, key="manual_v2", index=min(1, len(item_options)-1))
-    item3_label = st.selectbox(f"Select Vertex 3 ({current_level[:-1]}):", options=item_options, key="manual_v3", index=min(2, len(item_options)-1))
-
-    if st.button("Analyze Manual Selection", key="analyze_manual_button"):
+    # A form batches the three vertex choices into one rerun on submit instead of one rerun per selectbox
+    with st.form("manual_simplex_form"):
+        item1_label = st.selectbox(f"Select Vertex 1 ({current_level[:-1]}):", options=item_options, key="manual_v1", index=0)
+        item2_label = st.selectbox(f"Select Vertex 2 ({current_level[:-1]}):", options=item_options, key="manual_v2", index=min(1, len(item_options)-1))
+        item3_label = st.selectbox(f"Select Vertex 3 ({current_level[:-1]}):", options=item_options, key="manual_v3", index=min(2, len(item_options)-1))
+        manual_submitted = st.form_submit_button("Analyze Manual Selection", key="analyze_manual_button")
+
+    if manual_submitted:
         selected_labels = [item1_label, item2_label, item3_label]
-        if len(set(selected_labels)) != 3:
+        if len({item1_label, item2_label, item3_label}) != 3:
             st.error("Please select three distinct items.")
         else:
             try:
-                selected_embeddings = []
+                # SoA: resolve each vertex to its row in the corpus matrix instead of reading per-object embeddings
+                corpus_embeddings_array = None
+                corpus_labels = []
+                source_matrix, corpus_digest, row_of = None, None, {}.get
+
+                if current_level == 'Documents':
+                     # Already filtered for embeddings; reuses the cached matrix when the doc set is unchanged
+                     corpus_embeddings_array, corpus_labels = get_doc_corpus(docs_with_embed, normalized=True)
+                     source_matrix, corpus_digest = st.session_state.doc_matrix, st.session_state.doc_matrix_digest
+                     row_of = st.session_state.doc_title_to_index.get
+                elif current_level == 'Chunks':
+                     corpus_embeddings_array = st.session_state.get('all_chunk_embeddings_matrix_norm')
+                     corpus_labels = st.session_state.get('all_chunk_labels', [])
+                     source_matrix, corpus_digest = st.session_state.get('all_chunk_embeddings_matrix'), st.session_state.get('chunk_matrix_key')
+                     row_of = lambda label: (item_map.get(label) or {}).get('flat_list_index')
+
+                selected_rows = []
                 valid_embeddings = True
                 for label in selected_labels:
-                    item = item_map.get(label)
-                    # Check embedding attribute exists and is not None
-                    if item and hasattr(item, 'embedding') and item.embedding is not None:
-                        selected_embeddings.append(item.embedding)
-                    else:
+                    row = row_of(label)
+                    if row is None:
                         st.error(f"Could not find item or embedding for: '{label}'")
                         valid_embeddings = False; break
+                    selected_rows.append(row)
 
                 if valid_embeddings:
-                    mean_high_dim_emb = np.mean(np.array(selected_embeddings), axis=0)
-                    corpus_embeddings_array = None
-                    corpus_labels = []
-
-                    if current_level == 'Documents':
-                         corpus_items = list(item_map.values()) # Already filtered for embeddings
-                         corpus_embeddings_array = np.array([item.embedding for item in corpus_items])
-                         corpus_labels = list(item_map.keys())
-                    elif current_level == 'Chunks':
-                         corpus_embeddings_array = st.session_state.get('all_chunk_embeddings_matrix')
-                         corpus_labels = st.session_state.get('all_chunk_labels', [])
-
                     # Check corpus validity AFTER retrieving it
                     if corpus_embeddings_array is None or not corpus_labels:
                         st.error("Corpus for KNN search unavailable.")
                     elif corpus_embeddings_array.ndim != 2 or corpus_embeddings_array.shape[0] == 0:
                         st.error("Invalid corpus for KNN search (empty or wrong dimensions).")
                     else: # Corpus is valid
-                         indices, scores = analysis_service.find_k_nearest(mean_high_dim_emb, corpus_embeddings_array, k=1)
-                         if indices is not None and len(indices) > 0:
-                              nearest_neighbor_index = indices[0]
+                         nearest_neighbor_index, nearest_neighbor_score = centroid_nearest_cached(
+                             tuple(sorted(selected_rows)), corpus_digest, source_matrix, corpus_embeddings_array
+                         )
+                         if nearest_neighbor_index is not None:
                               if nearest_neighbor_index < len(corpus_labels): # Bounds check
                                  nearest_neighbor_label = corpus_labels[nearest_neighbor_index]
-                                 nearest_neighbor_score = scores[0]
                                  st.write("**Manual Selection Analysis Results:**")
                                  st.write(f"- Vertex 1: {item1_label}\n- Vertex 2: {item2_label}\n- Vertex 3: {item3_label}")
                                  st.write(f"**Semantic Center:** Closest item is **{nearest_neighbor_label}**")
@@ -826,7 +1167,7 @@ else:
     num_items = 0
 
     if analysis_level == 'Documents':
-        items_with_embeddings = [doc for doc in st.session_state.documents if doc.embedding is not None]
+        items_with_embeddings, _ = get_embedded_docs()
         num_items = len(items_with_embeddings)
         query_options = {doc.title: doc.title for doc in items_with_embeddings}
     elif analysis_level == 'Chunks':
@@ -847,56 +1188,62 @@ else:
 
             if st.button("Find Nearest Neighbors"):
                 query_emb = None
-                query_id = selected_key # Use label/title as ID for self-comparison
+                query_row = None # Corpus row of the query, masked out of its own neighbours
 
                 try:
                     # --- Get Query Embedding ---
                     if analysis_level == 'Documents':
-                        doc_map = {doc.title: doc for doc in items_with_embeddings} # Use already filtered list
-                        query_item_obj = doc_map.get(selected_key)
-                        if query_item_obj: query_emb = query_item_obj.embedding
+                        # Row of the cached document matrix; no per-click title map or float16 upcast
+                        doc_matrix_knn, _ = get_doc_corpus(items_with_embeddings)
+                        query_row = st.session_state.doc_title_to_index.get(selected_key)
+                        if query_row is not None and doc_matrix_knn is not None: query_emb = doc_matrix_knn[query_row]
                     elif analysis_level == 'Chunks':
                          lookup = st.session_state.get('chunk_label_lookup_dict', {})
-                         query_item_obj = lookup.get(selected_key)
-                         if query_item_obj: query_emb = query_item_obj.embedding
+                         query_entry = lookup.get(selected_key)
+                         chunk_matrix_knn = st.session_state.get('all_chunk_embeddings_matrix')
+                         if query_entry and chunk_matrix_knn is not None:
+                             query_row = query_entry['flat_list_index']
+                             query_emb = chunk_matrix_knn[query_row]
 
                     # --- Perform KNN if Query Embedding Found ---
                     if query_emb is not None:
                         corpus_embeddings = None
+                        corpus_i8 = None
+                        corpus_digest = None
                         corpus_labels = []
                         if analysis_level == 'Documents':
                             # Use the already prepared list/map
                              if items_with_embeddings:
-                                corpus_embeddings = np.array([d.embedding for d in items_with_embeddings])
-                                corpus_labels = [d.title for d in items_with_embeddings]
+                                corpus_embeddings, corpus_labels = get_doc_corpus(items_with_embeddings, normalized=True)
+                                corpus_digest = st.session_state.doc_matrix_digest
                         elif analysis_level == 'Chunks':
-                            corpus_embeddings = st.session_state.get('all_chunk_embeddings_matrix')
+                            corpus_embeddings = st.session_state.get('all_chunk_embeddings_matrix_norm')
+                            corpus_i8 = st.session_state.get('all_chunk_embeddings_matrix_i8')
+                            corpus_digest = st.session_state.get('chunk_matrix_key')
                             corpus_labels = st.session_state.get('all_chunk_labels', [])
 
                         # Validate corpus before proceeding
                         if corpus_embeddings is None or not corpus_labels or corpus_embeddings.ndim != 2 or corpus_embeddings.shape[0] < 1:
                              st.error(f"Invalid or empty corpus for {analysis_level} KNN search.")
                         else:
-                             indices, scores = analysis_service.find_k_nearest(query_emb, corpus_embeddings, k=k_neighbors)
+                             knn_index = get_knn_index(corpus_digest, corpus_embeddings) if corpus_digest else None
+                             indices, scores = analysis_service.find_k_nearest(
+                                 query_emb, corpus_embeddings, k=k_neighbors, pre_normalized=True, corpus_i8=corpus_i8, index=knn_index,
+                                 exclude_index=query_row
+                             )
 
                              st.subheader(f"Top {k_neighbors} neighbors for: {selected_key}")
-                             results = []
-                             if indices is not None:
-                                 # Create a mapping from label/title to its index for efficient self-check if needed
-                                 # corpus_id_map = {label: idx for idx, label in enumerate(corpus_labels)}
-                                 # query_idx = corpus_id_map.get(query_id)
-
-                                 for idx, score in zip(indices, scores):
-                                     # Check bounds just in case
-                                     if 0 <= idx < len(corpus_labels):
-                                         neighbor_label = corpus_labels[idx]
-                                         # find_k_nearest should already exclude self, rely on that
-                                         results.append({"Neighbor": neighbor_label, "Similarity Score": f"{score:.4f}"})
-                                     else:
-                                         st.warning(f"Neighbor index {idx} out of bounds.")
-
-                             if results:
-                                 st.table(results)
+                             # Indices come from a search over this same corpus, so one vectorized mask replaces per-row checks
+                             neighbor_indices = np.asarray(indices if indices is not None else [], dtype=np.intp)
+                             neighbor_scores = np.asarray(scores if scores is not None else [], dtype=np.float32)
+                             in_bounds = (neighbor_indices >= 0) & (neighbor_indices < len(corpus_labels))
+
+                             if in_bounds.any():
+                                 results_df = pd.DataFrame({
+                                     "Neighbor": [corpus_labels[i] for i in neighbor_indices[in_bounds]], # k lookups, no O(N) label array
+                                     "Similarity Score": np.char.mod("%.4f", neighbor_scores[in_bounds]),
+                                 })
+                                 st.table(results_df)
                              else:
                                  st.write("No distinct neighbors found.")
                     else:
@@ -935,16 +1282,18 @@ else:
     if st.button("Show Semantic Graph", key="show_graph_button"):
          # Retrieve data from session state (already checked existence)
          labels = st.session_state.get('all_chunk_labels') # Short labels
-         embeddings = st.session_state.get('all_chunk_embeddings_matrix')
-         lookup = st.session_state.get('chunk_label_lookup_dict', {}) # {short_label: (chunk_obj, doc_title)}
+         # Float32 row-normalised copy: the float16 raw matrix would be upcast on every build (cosine is unchanged)
+         embeddings = st.session_state.get('all_chunk_embeddings_matrix_norm')
+         lookup = st.session_state.get('chunk_label_lookup_dict', {}) # {short_label: {'doc_index', 'chunk_index', 'flat_list_index', 'doc_title'}}
+         chunk_source_titles = st.session_state.get('all_chunk_source_titles', []) # Row-aligned with labels, built at embedding time
          source_docs_for_graph = None # Initialize
 
          if labels and embeddings is not None and lookup:
               try:
-                  # Derive source documents reliably using the lookup dict
-                  source_docs_for_graph = [lookup[label][1] for label in labels if label in lookup]
-                  # Basic validation
-                  if len(source_docs_for_graph) != len(labels):
+                  # Source documents are already stored row by row, in label order
+                  if len(chunk_source_titles) == len(labels):
+                      source_docs_for_graph = chunk_source_titles
+                  else:
                        st.warning("Mismatch generating source doc list for graph. Coloring might be inaccurate.")
                        source_docs_for_graph = [label.split('::')[0] for label in labels] # Fallback
               except Exception as e:
@@ -954,99 +1303,94 @@ else:
          graph_data = None
          if labels and embeddings is not None and source_docs_for_graph:
              with st.spinner(f"Generating graph with threshold {similarity_threshold}..."):
-                 graph_data = analysis_service.create_semantic_graph(
+                 matrix_key = st.session_state.get('chunk_matrix_key') or hashlib.blake2b(embeddings.tobytes(), digest_size=16).hexdigest()
+                 graph_data = build_semantic_graph_cached(
+                     matrix_key,
+                     tuple(labels),
+                     tuple(source_docs_for_graph),
+                     similarity_threshold,
                      embeddings,
-                     labels, 
-                     source_documents=source_docs_for_graph, 
-                     similarity_threshold=similarity_threshold
+                     # Threshold-independent; reused across slider changes (None above the size cap)
+                     get_chunk_sim_matrix()
                  )
-         elif not (labels and embeddings and lookup):
+         elif not (labels and embeddings is not None and lookup):
              st.error("Chunk embedding data (labels, matrix, or lookup) is missing. Please regenerate embeddings.")
          elif not source_docs_for_graph:
              pass 
 
-         # Unpack graph_data if it was successfully generated
-         if graph_data: 
-             if len(graph_data) == 3:
-                  semantic_graph, graph_metrics, communities = graph_data 
-                  node_degrees = graph_metrics.get('degrees', {})
-                  node_betweenness = graph_metrics.get('betweenness', {})
-             else:
-                  st.error("Graph generation service returned unexpected data format.")
-                  # Reset to ensure clean state if unpacking failed
-                  semantic_graph, graph_metrics, communities = None, {}, None
-                  node_degrees, node_betweenness = {}, {}
-         elif labels and embeddings is not None and source_docs_for_graph: # graph_data is None but inputs were ok
+         # Unpack graph_data in one step; the service signals failure with (None, None, None)
+         graph_ok = bool(graph_data) and len(graph_data) == 3 and graph_data[0] is not None
+         semantic_graph, graph_metrics, communities = graph_data if graph_ok else (None, {}, None)
+         graph_metrics = graph_metrics or {}
+         node_degrees = graph_metrics.get('degrees', {})
+         node_betweenness = graph_metrics.get('betweenness', {})
+         if graph_data and len(graph_data) != 3:
+             st.error("Graph generation service returned unexpected data format.")
+         elif not graph_ok and labels and embeddings is not None and source_docs_for_graph: # Inputs were ok
              st.error("Failed to generate semantic graph data from service (service returned None).")
-             # Reset to ensure clean state
-             semantic_graph, graph_metrics, communities = None, {}, None
-             node_degrees, node_betweenness = {}, {}
 
     # Display graph and metrics if semantic_graph is not None
     # This section will now always have node_degrees and node_betweenness initialized
     if semantic_graph:
         if semantic_graph.number_of_nodes() > 0:
             st.success(f"Generated graph with {semantic_graph.number_of_nodes()} nodes and {semantic_graph.number_of_edges()} edges.")
-            # --- Visualization Option: Graphviz (Static, with COLOR) ---
-            try:
-                if semantic_graph.number_of_nodes() < 150:
-                    pydot_graph = nx.nx_pydot.to_pydot(semantic_graph)
-                    pydot_graph.set_graph_defaults(overlap='scale', sep='+5', splines='true')
-                    pydot_graph.set_node_defaults(shape='ellipse')
-                    pydot_graph.set_prog('neato')
-                    st.graphviz_chart(pydot_graph.to_string())
-                else:
-                    st.info(f"Graph too large ({semantic_graph.number_of_nodes()} nodes) for direct Graphviz visualization.")
-            except ImportError:
-                st.warning("Graphviz / pydot not installed. Cannot display static graph. Ensure `pydot` is in requirements.txt")
-            except AttributeError as e:
-                st.warning(f"Could not render graph via pydot. Is `pydot` installed correctly? Error: {e}")
-            except Exception as viz_error:
-                st.error(f"Error rendering graph: {viz_error}")
+            if semantic_graph.number_of_edges() == 0:
+                # Nothing to lay out or draw; skip the spring layout and figure build
+                st.info("No edges above threshold; try lowering the similarity threshold.")
+            else:
+                # --- Visualization: in-process spring layout rendered with Plotly (colored by source document) ---
+                try:
+                    graph_to_draw = semantic_graph
+                    if semantic_graph.number_of_nodes() > MAX_GRAPH_NODES_RENDERED:
+                        # Thin to the densest core (O(V+E)) so the render stays bounded; top-degree nodes if cores stay too big
+                        k = 2
+                        graph_to_draw = nx.k_core(semantic_graph, k=k)
+                        while graph_to_draw.number_of_nodes() > MAX_GRAPH_NODES_RENDERED and k < 10:
+                            k += 1
+                            graph_to_draw = nx.k_core(semantic_graph, k=k)
+                        if graph_to_draw.number_of_nodes() > MAX_GRAPH_NODES_RENDERED or graph_to_draw.number_of_nodes() == 0:
+                            top_nodes, _ = top_n_items(node_degrees or dict(semantic_graph.degree()), MAX_GRAPH_NODES_RENDERED, np.int32)
+                            graph_to_draw = semantic_graph.subgraph(top_nodes.tolist())
+                        st.caption(f"Showing {graph_to_draw.number_of_nodes()} of {semantic_graph.number_of_nodes()} nodes (densest part of the graph).")
+                    # Each node keeps its 'index' into labels, so colors stay aligned for any subgraph
+                    node_sources = [source_docs_for_graph[i] for i in nx.get_node_attributes(graph_to_draw, 'index').values()]
+                    graph_pos = graph_layout_cached(matrix_key, similarity_threshold, tuple(graph_to_draw.nodes()), graph_to_draw)
+                    graph_fig = visualization_service.plot_semantic_graph(graph_to_draw, color_categories=node_sources, pos=graph_pos)
+                    st.plotly_chart(graph_fig, use_container_width=True)
+                except Exception as viz_error:
+                    st.error(f"Error rendering graph: {viz_error}")
 
             # --- Display Top N Degrees ---
             if node_degrees:
                 st.subheader("Top Connected Chunks (Highest Degree)")
-                sorted_degrees = sorted(node_degrees.items(), key=lambda item: item[1], reverse=True)
                 top_n = 10
-                degrees_to_display = sorted_degrees[:top_n]
-                if not degrees_to_display or all(deg == 0 for _, deg in degrees_to_display):
+                top_labels, top_degrees = top_n_items(node_degrees, top_n, np.int32)
+                if top_degrees.size == 0 or top_degrees[0] == 0: # Sorted descending, so the first is the max
                     st.info("No nodes with connections found at this threshold.")
                 else:
-                    degree_data = [{"Chunk Label": label, "Degree (Connections)": degree}
-                                   for label, degree in degrees_to_display if degree > 0]
-                    if degree_data:
-                        degree_df = pd.DataFrame(degree_data)
-                        st.dataframe(degree_df, use_container_width=True, hide_index=True)
-                    else:
-                        st.info("Top nodes have 0 connections at this threshold.")
+                    connected = top_degrees > 0
+                    degree_df = pd.DataFrame({"Chunk Label": top_labels[connected],
+                                              "Degree (Connections)": top_degrees[connected]})
+                    st.dataframe(degree_df, use_container_width=True, hide_index=True)
             else:
                 st.warning("Node degrees were not calculated.")
 
             # --- Display Top N Betweenness ---
             if node_betweenness:
                  st.subheader("Top Bridge Chunks (Highest Betweenness Centrality)")
-                 # Sort betweenness by value descending
-                 sorted_betweenness = sorted(node_betweenness.items(), key=lambda item: item[1], reverse=True)
-
                  # Display top N (e.g., 10)
                  top_n_bw = 10
-                 betweenness_to_display = sorted_betweenness[:top_n_bw]
+                 top_bw_labels, top_bw = top_n_items(node_betweenness, top_n_bw, np.float32)
 
-                 if not betweenness_to_display or all(bw == 0 for _, bw in betweenness_to_display):
+                 if top_bw.size == 0 or top_bw[0] == 0:
                       st.info("No significant bridge nodes found (betweenness centrality is zero or near zero).")
                  else:
-                      # Prepare data for table display
-                      betweenness_data = [{
-                          "Chunk Label": label,
-                          "Betweenness Centrality": f"{centrality:.4f}" # Format for display
-                      } for label, centrality in betweenness_to_display if centrality > 0] # Only show if > 0
-
-                      if betweenness_data:
-                           betweenness_df = pd.DataFrame(betweenness_data)
-                           st.dataframe(betweenness_df, use_container_width=True, hide_index=True)
-                      else:
-                            st.info("Top nodes have zero betweenness centrality.")
+                      bridging = top_bw > 0 # Only show if > 0
+                      betweenness_df = pd.DataFrame({
+                          "Chunk Label": top_bw_labels[bridging],
+                          "Betweenness Centrality": np.char.mod("%.4f", top_bw[bridging]) # Format for display
+                      })
+                      st.dataframe(betweenness_df, use_container_width=True, hide_index=True)
             else:
                 st.warning("Betweenness centrality was not calculated.")
             # --- End Betweenness Display ---
@@ -1057,16 +1401,18 @@ else:
                  if not communities:
                       st.info("No distinct communities found at this threshold/resolution.")
                  else:
-                      # Sort communities by size (descending) for display
-                      communities.sort(key=len, reverse=True)
-                      for i, community_set in enumerate(communities):
-                           community_list = sorted(list(community_set)) # Sort members alphabetically
-                           with st.expander(f"Community {i+1} ({len(community_list)} members)"):
-                                # Display first N members for brevity
-                                max_members_to_show = 15
-                                st.write(community_list[:max_members_to_show])
-                                if len(community_list) > max_members_to_show:
+                      # Largest communities first; only the top MAX_COMMUNITIES_SHOWN are rendered
+                      top_communities = heapq.nlargest(min(MAX_COMMUNITIES_SHOWN, len(communities)), communities, key=len)
+                      max_members_to_show = 15 # Display first N members for brevity
+                      for i, community_set in enumerate(top_communities):
+                           # Partial sort: the alphabetically first N members, without sorting the whole set
+                           community_preview = heapq.nsmallest(max_members_to_show, community_set)
+                           with st.expander(f"Community {i+1} ({len(community_set)} members)"):
+                                st.write(community_preview)
+                                if len(community_set) > max_members_to_show:
                                      st.caption("... (more members hidden)")
+                      if len(communities) > len(top_communities):
+                           st.caption(f"Showing the {len(top_communities)} largest of {len(communities)} communities.")
             elif communities is None:
                  # Explicit message if detection failed (e.g., missing library)
                  st.warning("Community detection did not run (check logs/dependencies like 'python-louvain').")
@@ -1079,59 +1425,68 @@ else:
 
 # --- Display loaded documents details ---
 with st.expander("View Loaded Documents", expanded=False):
-    if st.session_state.documents:
-        for i, doc in enumerate(st.session_state.documents):
-            embed_status = "Yes" if doc.embedding is not None else "No"
-            st.markdown(f"**{i+1}. {doc.title}** - Doc Embedding: {embed_status}")
-
-            if hasattr(doc, 'chunks') and doc.chunks:
-                chunk_embed_counts = sum(1 for chunk in doc.chunks if chunk.embedding is not None)
-                st.markdown(f"    Chunks: {len(doc.chunks)} ({chunk_embed_counts} embedded)")
-            elif hasattr(doc, 'chunks'): # Chunking ran but yielded 0
-                 st.markdown("    Chunks: 0")
-            else: # Chunking not run
-                 st.markdown("    Chunks: Not Processed")
-            st.divider()
-    else:
-        st.write("No documents loaded.")
+    if st.checkbox("Load document list", key='show_docs', value=False):
+        if st.session_state.documents:
+            # One Arrow-serialised table instead of a markdown/divider pair per document
+            st.dataframe(get_doc_summary_rows(), use_container_width=True, hide_index=True)
+        else:
+            st.write("No documents loaded.")
 
 # --- (Optional) Computational Matrices Info Expander ---
 with st.expander("View Computational Matrices Info", expanded=False):
-    # Check chunk matrix exists in session state and is not None
-    chunk_matrix = st.session_state.get('all_chunk_embeddings_matrix')
-    if chunk_matrix is not None:
-        st.write(f"**Chunk Embedding Matrix:**")
-        st.write(f"- Shape: {chunk_matrix.shape}")
-        st.write(f"- Number of Chunks: {len(st.session_state.get('all_chunk_labels', []))}")
-
-        if st.button("Compute & Show Similarity Matrix Info"):
-            if analysis_service:
-                sim_matrix = analysis_service.calculate_similarity_matrix(chunk_matrix)
-                if sim_matrix is not None:
-                    st.write(f"**Chunk Similarity Matrix:**")
-                    st.write(f"- Shape: {sim_matrix.shape}")
-                    # Display heatmap only if few chunks
-                    if sim_matrix.shape[0] > 0 and sim_matrix.shape[0] < 25:
-                         try:
-                              import plotly.express as px
-                              fig = px.imshow(sim_matrix, text_auto=".2f", aspect="auto",
-                                                labels=dict(x="Chunk Index", y="Chunk Index", color="Similarity"),
-                                                # Use short labels for heatmap axes if possible
-                                                # x=st.session_state.get('all_chunk_labels', []),
-                                                # y=st.session_state.get('all_chunk_labels', []),
-                                                title="Chunk Similarity Matrix Heatmap")
-                              fig.update_xaxes(side="top", tickangle=45)
-                              st.plotly_chart(fig)
-                         except ImportError:
-                              st.warning("Plotly Express not found. Cannot display heatmap.")
-                         except Exception as e:
-                              st.error(f"Failed to generate similarity heatmap: {e}")
-                    elif sim_matrix.shape[0] >= 25:
-                         st.info(f"Similarity matrix ({sim_matrix.shape[0]}x{sim_matrix.shape[0]}) too large for heatmap.")
-                    # else: matrix is empty, do nothing
+    # Expander bodies run on every rerun even when collapsed, so the matrix work waits for this opt-in
+    if st.checkbox("Load matrix info", key='show_mat', value=False):
+        # Check chunk matrix exists in session state and is not None
+        chunk_matrix = st.session_state.get('all_chunk_embeddings_matrix')
+        if chunk_matrix is not None:
+            st.write(f"**Chunk Embedding Matrix:**")
+            st.write(f"- Shape: {chunk_matrix.shape}")
+            st.write(f"- Dtype: {chunk_matrix.dtype} ({chunk_matrix.nbytes / 1e6:.1f} MB)")
+            chunk_matrix_i8 = st.session_state.get('all_chunk_embeddings_matrix_i8')
+            if chunk_matrix_i8 is not None: # Quantised copy used for the KNN shortlist
+                st.write(f"- KNN shortlist copy: {chunk_matrix_i8.dtype} ({chunk_matrix_i8.nbytes / 1e6:.1f} MB)")
+            st.write(f"- Number of Chunks: {len(st.session_state.get('all_chunk_labels', []))}")
+
+            if st.button("Compute & Show Similarity Matrix Info"):
+                st.session_state.show_sim_matrix_info = True
+            # Once requested, later reruns redraw from the cached matrix instead of needing another click
+            if st.session_state.show_sim_matrix_info:
+                if analysis_service:
+                    # Session copy when within the cache cap, otherwise a build on the background thread
+                    sim_matrix, sim_pending = get_chunk_sim_matrix(), False
+                    if sim_matrix is None:
+                        sim_matrix, sim_pending = poll_background_sim_matrix()
+                    if sim_pending:
+                        wait_for_sim_matrix_job()
+                    elif sim_matrix is not None:
+                        st.write(f"**Chunk Similarity Matrix:**")
+                        st.write(f"- Shape: {sim_matrix.shape}")
+                        # Full-resolution heatmap for small matrices, block-averaged overview for large ones
+                        if sim_matrix.shape[0] > 0:
+                             try:
+                                  # The block-mean overview is rendered static (no hover/zoom handlers); full-resolution views keep hover for the values
+                                  static = sim_matrix.shape[0] > visualization_service.HEATMAP_MAX_SIDE
+                                  heatmap_fig = pio.from_json(similarity_heatmap_json(st.session_state.get('chunk_matrix_key'), sim_matrix))
+                                  st.plotly_chart(heatmap_fig, use_container_width=True,
+                                                  config={'staticPlot': static, 'displayModeBar': not static})
+                                  if static: # The overview hides detail, so offer a full-resolution window into it
+                                       n_sim = sim_matrix.shape[0]
+                                       st.write("**Full-resolution block:**")
+                                       row_col, col_col = st.columns(2)
+                                       row0 = int(row_col.number_input("First row", min_value=0, max_value=n_sim - HEATMAP_DETAIL_SIDE, value=0, step=HEATMAP_DETAIL_SIDE, key="sim_detail_row"))
+                                       col0 = int(col_col.number_input("First column", min_value=0, max_value=n_sim - HEATMAP_DETAIL_SIDE, value=0, step=HEATMAP_DETAIL_SIDE, key="sim_detail_col"))
+                                       detail_fig = visualization_service.plot_similarity_heatmap(
+                                            sim_matrix[row0:row0 + HEATMAP_DETAIL_SIDE, col0:col0 + HEATMAP_DETAIL_SIDE],
+                                            title=f"Chunks {row0}-{row0 + HEATMAP_DETAIL_SIDE - 1} vs {col0}-{col0 + HEATMAP_DETAIL_SIDE - 1}",
+                                            row_offset=row0, col_offset=col0,
+                                       )
+                                       st.plotly_chart(detail_fig, use_container_width=True)
+                             except Exception as e:
+                                  st.error(f"Failed to generate similarity heatmap: {e}")
+                        # else: matrix is empty, do nothing
+                    else:
+                        st.error("Failed to compute similarity matrix.")
                 else:
-                    st.error("Failed to compute similarity matrix.")
-            else:
-                st.error("Analysis Service not available.")
-    else:
-        st.info("Chunk embedding matrix not yet generated. Please generate embeddings.")
\ No newline at end of file
+                    st.error("Analysis Service not available.")
+        else:
+            st.info("Chunk embedding matrix not yet generated. Please generate embeddings.")
\ No newline at end of file
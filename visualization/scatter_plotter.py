@@ -1,10 +1,46 @@
-import plotly.express as px
 import numpy as np
-from typing import List, Optional
-import plotly.graph_objects as go # Import go for figure type hint
+from typing import List, Optional, Dict, Tuple
+import plotly.graph_objects as go
+import networkx as nx
+from plotly.colors import qualitative
+
+def _column_views(coords: np.ndarray) -> tuple:
+    """Returns each coordinate column as a contiguous 1-D array so Plotly can serialize it without a strided copy."""
+    return tuple(np.ascontiguousarray(coords[:, i]) for i in range(coords.shape[1]))
+
+def _category_colors(categories: List[str], color_discrete_map: Optional[dict] = None) -> Tuple[dict, Dict[str, str]]:
+    """Marker color settings for per-point categories (first-appearance order, Plotly palette for unmapped categories).
+
+    Points carry small integer category codes plus a stepped colorscale instead of one hex string each,
+    so the color array is sent to the browser as a compact typed array.
+    """
+    palette = qualitative.Plotly
+    code_of = {}
+    codes = np.fromiter((code_of.setdefault(c, len(code_of)) for c in categories), dtype=np.int64, count=len(categories))
+    category_to_color = {category: (color_discrete_map or {}).get(category, palette[i % len(palette)]) for i, category in enumerate(code_of)}
+    n_categories = max(len(category_to_color), 1)
+    colorscale = []
+    for i, color in enumerate(category_to_color.values()): # Flat segment per code: code i lands mid-segment
+        colorscale += [[i / n_categories, color], [(i + 1) / n_categories, color]]
+    marker = dict(color=codes.astype(np.min_scalar_type(n_categories - 1)), colorscale=colorscale,
+                  cmin=-0.5, cmax=n_categories - 0.5, showscale=False)
+    return marker, category_to_color
 
 class VisualizationService:
     """Handles the creation of visualizations for embedding data."""
+    LARGE_PLOT_N = 5000 # Above this, pre-format hover strings instead of per-point templating
+    SCATTER3D_TEXT_MAX_N = 50 # 3D plots draw always-visible point labels only up to this size; hover covers the rest
+    HEATMAP_MAX_SIDE = 256 # Larger matrices are block-averaged down to at most this many rows/columns
+
+    @staticmethod
+    def _add_legend_entries(fig: go.Figure, category_to_color: Dict[str, str], trace_cls, legend_title: str) -> None:
+        """Adds empty, legend-only traces so a single data trace keeps a per-category legend."""
+        # The data stays in trace 0, so plot selection point indices map straight onto the input rows
+        n_dims = 3 if trace_cls is go.Scatter3d else 2
+        empty = dict(zip(('x', 'y', 'z')[:n_dims], ([None],) * n_dims))
+        for category, color in category_to_color.items():
+            fig.add_trace(trace_cls(**empty, mode='markers', marker=dict(color=color), name=str(category), showlegend=True, hoverinfo='skip'))
+        fig.update_layout(legend_title_text=legend_title)
 
     def plot_scatter_2d(
         self, 
@@ -22,18 +58,27 @@ class VisualizationService:
         if color_categories is not None and len(color_categories) != coords.shape[0]:
              raise ValueError(f"Color categories must be None or a list with length matching coordinate rows ({coords.shape[0]}).")
 
-        
-        fig = px.scatter(
-            x=coords[:, 0],
-            y=coords[:, 1],
-            hover_name=labels, 
-            title=title,
-            color=color_categories,
-            color_discrete_map=color_discrete_map,
-            labels={'color': 'Source Document'} if color_categories else None 
-        )
-        # Ensure only markers are shown. Hover behavior should come from hover_name.
-        fig.update_traces(mode='markers')
+        x, y = _column_views(coords)
+        marker = {}
+        category_to_color = {}
+        if color_categories:
+            category_marker, category_to_color = _category_colors(color_categories, color_discrete_map)
+            marker.update(category_marker)
+
+        # Build the WebGL trace directly from the arrays (no DataFrame round-trip through plotly.express)
+        if coords.shape[0] > self.LARGE_PLOT_N:
+            # For large N, build the hover strings once up front instead of per-point templating
+            hover = [f"{lab}<br>x: {x_:.3f}<br>y: {y_:.3f}" for lab, x_, y_ in zip(labels, x, y)]
+            trace = go.Scattergl(x=x, y=y, mode='markers', marker=marker, hovertext=hover, hoverinfo='text', showlegend=False)
+        else:
+            trace = go.Scattergl(
+                x=x, y=y, mode='markers', marker=marker, text=labels, showlegend=False,
+                hovertemplate="<b>%{text}</b><br>x: %{x:.3f}<br>y: %{y:.3f}<extra></extra>"
+            )
+        fig = go.Figure(trace)
+        fig.update_layout(title=title, xaxis_title='x', yaxis_title='y')
+        if category_to_color:
+            self._add_legend_entries(fig, category_to_color, go.Scattergl, 'Source Document')
         # Optional: Adjust legend position
         # fig.update_layout(legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
         return fig
@@ -53,15 +98,105 @@ class VisualizationService:
         if color_data is not None and len(color_data) != coords.shape[0]:
              raise ValueError(f"Color data must be None or a list with length matching coordinate rows ({coords.shape[0]}).")
 
-        fig = px.scatter_3d(
-            x=coords[:, 0],
-            y=coords[:, 1],
-            z=coords[:, 2],
-            text=labels, # Use labels for hover text
-            title=title,
-            color=color_data, # Use color data for point colors
-            labels={'color': 'Source'} if color_data else None # Add legend title if color is used
-        )
-        # Update hover template for clarity
-        fig.update_traces(hovertemplate="<b>%{text}</b><br>x: %{x:.3f}<br>y: %{y:.3f}<br>z: %{z:.3f}<extra></extra>")
-        return fig 
\ No newline at end of file
+        x, y, z = _column_views(coords)
+        marker = {}
+        category_to_color = {}
+        if color_data:
+            category_marker, category_to_color = _category_colors(color_data) # Use color data for point colors
+            marker.update(category_marker)
+
+        if coords.shape[0] > self.LARGE_PLOT_N:
+            # As in plot_scatter_2d: format hover strings once here instead of templating per point in the browser
+            hover = [f"<b>{lab}</b><br>x: {x_:.3f}<br>y: {y_:.3f}<br>z: {z_:.3f}" for lab, x_, y_, z_ in zip(labels, x, y, z)]
+            trace = go.Scatter3d(x=x, y=y, z=z, mode='markers', marker=marker, hovertext=hover, hoverinfo='text', showlegend=False)
+        else:
+            trace = go.Scatter3d(
+                x=x,
+                y=y,
+                z=z,
+                mode='markers+text' if coords.shape[0] <= self.SCATTER3D_TEXT_MAX_N else 'markers',
+                text=labels, # Use labels for hover text
+                marker=marker,
+                showlegend=False,
+                # Hover template for clarity
+                hovertemplate="<b>%{text}</b><br>x: %{x:.3f}<br>y: %{y:.3f}<br>z: %{z:.3f}<extra></extra>"
+            )
+        fig = go.Figure(trace)
+        fig.update_layout(title=title)
+        if category_to_color:
+            self._add_legend_entries(fig, category_to_color, go.Scatter3d, 'Source') # Add legend title if color is used
+        return fig
+
+    def plot_semantic_graph(
+        self,
+        graph: nx.Graph,
+        title: str = "Semantic Chunk Graph",
+        color_categories: Optional[List[str]] = None,
+        seed: int = 42,
+        pos: Optional[Dict[str, np.ndarray]] = None
+    ) -> go.Figure:
+        """Lays out a graph with NetworkX's NumPy spring layout and draws it as Plotly edge + node traces.
+
+        Pass pos (node -> (x, y), e.g. a cached spring_layout) to skip the layout step.
+        """
+        if color_categories is not None and len(color_categories) != graph.number_of_nodes():
+             raise ValueError(f"Color categories must be None or a list with one entry per node ({graph.number_of_nodes()}).")
+
+        nodes = list(graph.nodes())
+        if pos is None:
+            pos = nx.spring_layout(graph, seed=seed) # Fruchterman-Reingold in-process, no Graphviz subprocess
+        node_xy = np.array([pos[node] for node in nodes], dtype=np.float32).reshape(-1, 2)
+        node_index = {node: i for i, node in enumerate(nodes)}
+
+        # All edges as one line trace; NaN breaks the line between segments
+        edge_xy = np.full((graph.number_of_edges() * 3, 2), np.nan, dtype=np.float32)
+        if graph.number_of_edges():
+            ends = np.array([(node_index[u], node_index[v]) for u, v in graph.edges()])
+            edge_xy[0::3] = node_xy[ends[:, 0]]
+            edge_xy[1::3] = node_xy[ends[:, 1]]
+        edge_x, edge_y = _column_views(edge_xy)
+        node_x, node_y = _column_views(node_xy)
+
+        marker = dict(size=10, line=dict(width=1, color='#444444'))
+        category_to_color = {}
+        if color_categories:
+            category_marker, category_to_color = _category_colors(color_categories)
+            marker.update(category_marker)
+        degrees = [graph.degree(node) for node in nodes]
+
+        fig = go.Figure([
+            go.Scattergl(x=edge_x, y=edge_y, mode='lines', line=dict(width=0.7, color='#AAAAAA'), hoverinfo='skip', showlegend=False),
+            go.Scattergl(
+                x=node_x, y=node_y, mode='markers', marker=marker, text=nodes, customdata=degrees, showlegend=False,
+                hovertemplate="<b>%{text}</b><br>Degree: %{customdata}<extra></extra>"
+            ),
+        ])
+        fig.update_layout(title=title, xaxis=dict(visible=False), yaxis=dict(visible=False, scaleanchor='x'))
+        if category_to_color:
+            self._add_legend_entries(fig, category_to_color, go.Scattergl, 'Source Document')
+        return fig
+
+    def plot_similarity_heatmap(
+        self, similarity_matrix: np.ndarray, title: str = "Chunk Similarity Matrix Heatmap", row_offset: int = 0, col_offset: int = 0
+    ) -> go.Figure:
+        """Draws a square similarity matrix (or a sub-block starting at row_offset/col_offset) as one go.Heatmap trace, block-averaging it first when it is large."""
+        n = similarity_matrix.shape[0]
+        z = similarity_matrix
+        block = max(1, -(-n // self.HEATMAP_MAX_SIDE)) # ceil(n / HEATMAP_MAX_SIDE)
+        if block > 1:
+            # Block means via reduceat, so the ragged last block is kept rather than cropped
+            edges = np.arange(0, n, block)
+            sizes = np.diff(np.append(edges, n)).astype(np.float32)
+            z = np.add.reduceat(np.add.reduceat(similarity_matrix, edges, axis=0), edges, axis=1)
+            z = z / np.outer(sizes, sizes)
+        heatmap = dict(z=z, colorscale='Viridis', zmin=-1, zmax=1, zsmooth=False, colorbar=dict(title="Similarity"))
+        if block > 1:
+            heatmap['hovertemplate'] = f"rows %{{y}}*{block} vs cols %{{x}}*{block}: mean %{{z:.3f}}<extra></extra>"
+        else: # Values are shown on hover only; per-cell text labels would add N^2 SVG text nodes
+            heatmap['hovertemplate'] = "Chunk %{y} vs Chunk %{x}: %{z:.3f}<extra></extra>"
+            heatmap.update(x=np.arange(col_offset, col_offset + n), y=np.arange(row_offset, row_offset + n)) # Corpus indices for sub-blocks
+        fig = go.Figure(go.Heatmap(**heatmap))
+        fig.update_layout(title=title if block == 1 else f"{title} ({block}x{block} block means)",
+                          xaxis_title="Chunk Index", yaxis_title="Chunk Index", yaxis_autorange='reversed')
+        fig.update_xaxes(side="top")
+        return fig